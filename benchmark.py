@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+To benchmark the rendering of map snapshots, without connecting to Discord
+"""
+from __future__ import print_function, division
+__date__ = '2026-10-16'
+
+# Import statements
+import sys
+import json
+import logging
+import resource
+import time
+from argparse import ArgumentParser
+import numpy as np
+import main as bot
+from main import MapController, Encoding
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process so far, in MB"""
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def get_coordinates(grid):
+    """Returns a grid x grid list of (lat, lng) spread over the world map"""
+    lats = np.linspace(-4500, -100, grid)
+    lngs = np.linspace(100, 8100, grid)
+    return [(float(lat), float(lng)) for lat in lats for lng in lngs]
+
+def run_case(coordinates, zoom, include_world, marker, encoding, repeat):
+    """Renders the snapshots of all coordinates at the given settings and returns the measurements
+    """
+    latencies = []
+    sizes = []
+    cpu_start = time.process_time()
+    for _ in range(repeat):
+        for lat, lng in coordinates:
+            if marker:
+                map_controller = MapController(lat, lng, zoom, lat, lng)
+            else:
+                map_controller = MapController(lat, lng, zoom)
+            start = time.perf_counter()
+            data, _ = map_controller.render_snapshot(include_world, encoding)
+            latencies.append(time.perf_counter()-start)
+            sizes.append(len(data))
+    cpu_time = time.process_time()-cpu_start
+    latencies = np.array(latencies)*1000
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+            'zoom': zoom,
+            'include_world': include_world,
+            'marker': marker,
+            'count': len(latencies),
+            'mean_ms': float(np.mean(latencies)),
+            'p50_ms': float(p50),
+            'p95_ms': float(p95),
+            'p99_ms': float(p99),
+            'throughput_per_core': len(latencies)/cpu_time if cpu_time > 0 else None,
+            'mean_size_bytes': float(np.mean(sizes)),
+            }
+
+def get_case_key(case):
+    return (case['zoom'], case['include_world'], case['marker'])
+
+def compare(results, baseline, tolerance):
+    """Prints the change of p50 latency and size of each case against the baseline results
+
+    Returns the number of cases that are slower than the baseline by more than the tolerance.
+    """
+    baseline_cases = {get_case_key(case): case for case in baseline['cases']}
+    regressions = 0
+    for case in results['cases']:
+        base = baseline_cases.get(get_case_key(case))
+        if base is None:
+            continue
+        latency_change = case['p50_ms']/base['p50_ms']-1
+        size_change = case['mean_size_bytes']/base['mean_size_bytes']-1
+        flag = ''
+        if latency_change > tolerance:
+            flag = ' <-- slower'
+            regressions += 1
+        print(f'zoom {case["zoom"]:>4}, world {case["include_world"]!s:>5}, marker {case["marker"]!s:>5}: '
+              f'p50 {latency_change:+.1%}, size {size_change:+.1%}{flag}', file=sys.stderr)
+    return regressions
+
+def main(args=None):
+    parser = ArgumentParser(description='Benchmark the rendering of map snapshots')
+    parser.add_argument('--res_path', default=bot.RES_PATH,
+                        help='The path to the directory with the world map and marker images')
+    parser.add_argument('--map_storage', choices=['memory', 'mmap'], default=MapController.map_storage,
+                        help='Whether to keep the world map in memory or memory-map it from raw pixel files')
+    parser.add_argument('--encoding', choices=Encoding.ALL, default=Encoding.PNG,
+                        help='The image encoding of the snapshots')
+    parser.add_argument('--zooms', type=float, nargs='+', default=[z/2 for z in range(-6, 11)],
+                        help='The zoom levels to benchmark')
+    parser.add_argument('--grid', type=int, default=4,
+                        help='The number of latitudes and longitudes to render, spread over the world map')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='The number of times to render each snapshot')
+    parser.add_argument('--output', default=None,
+                        help='The path to write the results as JSON. Printed to stdout if not specified')
+    parser.add_argument('--baseline', default=None,
+                        help='The path to the JSON results of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='The relative increase of p50 latency over the baseline considered a regression')
+    args = parser.parse_args(args)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    bot.RES_PATH = args.res_path
+    MapController.map_storage = args.map_storage
+
+    rss_before_load = peak_rss_mb()
+    start = time.perf_counter()
+    if args.map_storage == 'mmap':
+        MapController.update_map_cache()
+    bot.init_worker()
+    load_time = time.perf_counter()-start
+    rss_after_load = peak_rss_mb()
+
+    coordinates = get_coordinates(args.grid)
+    cases = []
+    for zoom in args.zooms:
+        for include_world in [False, True]:
+            for marker in [False, True]:
+                cases.append(run_case(coordinates, zoom, include_world, marker, args.encoding, args.repeat))
+
+    all_p50 = [case['p50_ms'] for case in cases]
+    results = {
+            'config': {
+                'map_storage': args.map_storage,
+                'encoding': args.encoding,
+                'grid': args.grid,
+                'repeat': args.repeat,
+                },
+            'load_time_s': load_time,
+            'rss_before_load_mb': rss_before_load,
+            'rss_after_load_mb': rss_after_load,
+            'peak_rss_mb': peak_rss_mb(),
+            'median_p50_ms': float(np.median(all_p50)),
+            'cases': cases,
+            }
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, 'r') as infile:
+            baseline = json.load(infile)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f'{regressions} cases are slower than the baseline', file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+To index the locations in the Day R world map
+"""
+from __future__ import print_function, division
+__date__ = '2026-10-16'
+
+# Import statements
+import heapq
+from collections import Counter
+from collections.abc import Mapping
+from pathlib import Path
+from difflib import SequenceMatcher
+import numpy as np
+
+class LocationIndex:
+    """Uniform grid over the location coordinates, for nearest neighbour and range queries
+
+    Locations sharing the same coordinates (the same place in different languages) are stored as one point.
+    """
+    def __init__(self, locations, labels=None, cell_size=128):
+        """Builds the index
+
+        locations: Mapping from location name into (lat, lng, size)
+        labels: Mapping from (lat, lng) into the name to show for that point. If not given, one of the names is used
+        cell_size: The width and height of each grid cell
+        """
+        if labels is None:
+            labels = {}
+        self.cell_size = cell_size
+        points = {}
+        for name, (lat, lng, size) in locations.items():
+            if (lat, lng) not in points:
+                points[(lat, lng)] = (size, [])
+            points[(lat, lng)][1].append(name)
+        # Each point is (lat, lng, size, label, names)
+        self.points = []
+        for (lat, lng), (size, names) in sorted(points.items()):
+            names.sort()
+            self.points.append((lat, lng, size, labels.get((lat, lng), names[0]), names))
+        self.cells = {}
+        for idx, (lat, lng, _, _, _) in enumerate(self.points):
+            self.cells.setdefault(self.get_cell(lat, lng), []).append(idx)
+        if self.cells:
+            rows = [row for row, _ in self.cells]
+            cols = [col for _, col in self.cells]
+            self.bounds = (min(rows), min(cols), max(rows), max(cols))
+        else:
+            self.bounds = (0, 0, -1, -1)
+
+    def __len__(self):
+        return len(self.points)
+
+    def get_cell(self, lat, lng):
+        return (int(lat // self.cell_size), int(lng // self.cell_size))
+
+    def get_ring(self, cell, ring):
+        """Yields the indices of the points in the cells at exactly the given Chebyshev distance from the cell
+
+        Only the cells within the bounds of the grid are looked at.
+        """
+        row, col = cell
+        min_row, min_col, max_row, max_col = self.bounds
+        for r in range(max(row-ring, min_row), min(row+ring, max_row)+1):
+            if ring == 0 or r in (row-ring, row+ring):
+                cols = range(max(col-ring, min_col), min(col+ring, max_col)+1)
+            else:
+                cols = [c for c in (col-ring, col+ring) if min_col <= c <= max_col]
+            for c in cols:
+                yield from self.cells.get((r, c), ())
+
+    def distance(self, idx, lat, lng):
+        point_lat, point_lng = self.points[idx][:2]
+        return ((point_lat-lat)**2 + (point_lng-lng)**2)**0.5
+
+    def nearest(self, lat, lng, k=1):
+        """Returns the k nearest points to (lat, lng), as a sorted list of (distance, point)
+        """
+        if not self.points or k <= 0:
+            return []
+        cell = self.get_cell(lat, lng)
+        min_row, min_col, max_row, max_col = self.bounds
+        max_ring = max(abs(cell[0]-min_row), abs(cell[0]-max_row), abs(cell[1]-min_col), abs(cell[1]-max_col))
+        # The rings closer than the bounds of the grid are empty
+        min_ring = max(min_row-cell[0], cell[0]-max_row, min_col-cell[1], cell[1]-max_col, 0)
+        # Max-heap (by negated distance) of the k nearest points found so far
+        heap = []
+        for ring in range(min_ring, max_ring+1):
+            for idx in self.get_ring(cell, ring):
+                item = (-self.distance(idx, lat, lng), idx)
+                if len(heap) < k:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+            # Points in the next rings are at least this far away
+            if len(heap) == k and -heap[0][0] <= ring*self.cell_size:
+                break
+        return [(-distance, self.points[idx]) for distance, idx in sorted(heap, reverse=True)]
+
+    def within_box(self, lat1, lng1, lat2, lng2):
+        """Returns the indices of the points inside the box with the given corners"""
+        lat1, lat2 = min(lat1, lat2), max(lat1, lat2)
+        lng1, lng2 = min(lng1, lng2), max(lng1, lng2)
+        row1, col1 = self.get_cell(lat1, lng1)
+        row2, col2 = self.get_cell(lat2, lng2)
+        result = []
+        for row in range(max(row1, self.bounds[0]), min(row2, self.bounds[2])+1):
+            for col in range(max(col1, self.bounds[1]), min(col2, self.bounds[3])+1):
+                for idx in self.cells.get((row, col), ()):
+                    lat, lng = self.points[idx][:2]
+                    if lat1 <= lat <= lat2 and lng1 <= lng <= lng2:
+                        result.append(idx)
+        return result
+
+    def within_radius(self, lat, lng, radius):
+        """Returns the points within the radius from (lat, lng), as a sorted list of (distance, point)
+        """
+        result = []
+        for idx in self.within_box(lat-radius, lng-radius, lat+radius, lng+radius):
+            distance = self.distance(idx, lat, lng)
+            if distance <= radius:
+                result.append((distance, idx))
+        result.sort()
+        return [(distance, self.points[idx]) for distance, idx in result]
+
+def get_trigrams(text):
+    """Returns the set of character trigrams of the text, padded so that the start and end of words count"""
+    text = f'  {text} '
+    return set(text[idx:idx+3] for idx in range(len(text)-2))
+
+class FuzzyIndex:
+    """Trigram index over names, to find the names most similar to a possibly misspelled query"""
+    def __init__(self, names):
+        self.names = sorted(set(names))
+        self.trigram_counts = []
+        self.postings = {}
+        for idx, name in enumerate(self.names):
+            trigrams = get_trigrams(name)
+            self.trigram_counts.append(len(trigrams))
+            for trigram in trigrams:
+                self.postings.setdefault(trigram, []).append(idx)
+
+    def __len__(self):
+        return len(self.names)
+
+    def search(self, query, limit=3, threshold=0.6, candidates=20):
+        """Returns up to limit names most similar to the query, as a sorted list of (similarity, name)
+
+        The names sharing the most trigrams with the query are reranked by their edit similarity,
+        and only those with similarity at least the threshold are returned.
+        """
+        query = query.lower().strip()
+        trigrams = get_trigrams(query)
+        shared = Counter()
+        for trigram in trigrams:
+            shared.update(self.postings.get(trigram, ()))
+        # Dice coefficient of the trigram sets
+        scores = [(2*count/(len(trigrams)+self.trigram_counts[idx]), idx) for idx, count in shared.items()]
+        result = []
+        for _, idx in heapq.nlargest(candidates, scores):
+            similarity = SequenceMatcher(None, query, self.names[idx]).ratio()
+            if similarity >= threshold:
+                result.append((similarity, self.names[idx]))
+        result.sort(key=lambda item: (-item[0], item[1]))
+        return result[:limit]
+
+class DistanceMatrix:
+    """All-pairs distance matrix between the points of a LocationIndex
+
+    The matrix is only computed the first time it is needed.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.point_ids = {point[:2]: idx for idx, point in enumerate(index.points)}
+        self.matrix = None
+
+    def get_matrix(self):
+        if self.matrix is None:
+            coordinates = np.array([point[:2] for point in self.index.points], dtype=np.float32).reshape(-1, 2)
+            self.matrix = np.empty((len(coordinates), len(coordinates)), dtype=np.float32)
+            # Computed row by row to avoid creating an N x N x 2 intermediate array
+            for idx, coordinate in enumerate(coordinates):
+                self.matrix[idx] = np.hypot(*(coordinates-coordinate).T)
+        return self.matrix
+
+    def get_distances(self, coordinates):
+        """Returns the distance matrix between the given list of (lat, lng) of indexed points"""
+        ids = [self.point_ids[coordinate] for coordinate in coordinates]
+        return self.get_matrix()[np.ix_(ids, ids)]
+
+def get_route_length(distances, order):
+    return sum(distances[order[idx], order[idx+1]] for idx in range(len(order)-1))
+
+def find_short_route(distances):
+    """Returns a short order of visiting all stops, starting from stop 0, given their distance matrix
+
+    The route is built by always going to the nearest unvisited stop, then improved with 2-opt moves
+    (reversing a part of the route) until no move makes it shorter.
+    """
+    count = len(distances)
+    if count <= 2:
+        return list(range(count))
+    distances = distances.tolist()
+    order = [0]
+    unvisited = set(range(1, count))
+    while unvisited:
+        last = order[-1]
+        nearest = min(unvisited, key=lambda stop: distances[last][stop])
+        order.append(nearest)
+        unvisited.remove(nearest)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, count-1):
+            for j in range(i+1, count):
+                # Reverse order[i:j+1], replacing edges (i-1, i) and (j, j+1)
+                a, b = order[i-1], order[i]
+                c = order[j]
+                change = distances[a][c] - distances[a][b]
+                if j+1 < count:
+                    d = order[j+1]
+                    change += distances[b][d] - distances[c][d]
+                if change < -1e-6:
+                    order[i:j+1] = reversed(order[i:j+1])
+                    improved = True
+    return order
+
+# The structure of each point in the compiled location database
+POINT_DTYPE = np.dtype([('lat', '<f8'), ('lng', '<f8'), ('size', '<f4')])
+
+def compile_locations(location_data):
+    """Compiles the parsed location marker data into arrays that can be saved and memory-mapped
+
+    Returns a dictionary with the following arrays:
+    - points: The unique (lat, lng, size), as a structured array with POINT_DTYPE
+    - labels: The (English) name to show for each point, joined with newlines as UTF-8 bytes
+    - names: All location names (in all languages, in lowercase), joined with newlines as UTF-8 bytes
+    - name_points: The index of the point of each name
+
+    For name collisions, the name refers to the biggest location.
+    """
+    locations = {}
+    labels = {}
+    for location in location_data:
+        lng, lat = location['geometry']['coordinates']
+        size = location['properties']['size']
+        names = location['properties']['name']
+        label = names.get('en', next(iter(names.values())))
+        labels[(lat, lng)] = label.split('<br>/ ')[-1]
+        for name in names.values():
+            name = name.lower()
+            if '<br>' in name:
+                name = name.split('<br>/ ')[-1]
+            if name not in locations or size > locations[name][2]:
+                locations[name] = (lat, lng, size)
+    points = sorted(set(locations.values()))
+    point_ids = {point: idx for idx, point in enumerate(points)}
+    names = sorted(locations)
+    return {
+            'points': np.array(points, dtype=POINT_DTYPE),
+            'labels': np.frombuffer('\n'.join(labels[point[:2]] for point in points).encode('utf-8'), dtype=np.uint8),
+            'names': np.frombuffer('\n'.join(names).encode('utf-8'), dtype=np.uint8),
+            'name_points': np.array([point_ids[locations[name]] for name in names], dtype=np.int32),
+            }
+
+def save_compiled_locations(arrays, path):
+    """Saves the arrays from compile_locations into the directory"""
+    Path(path).mkdir(parents=True, exist_ok=True)
+    for key, array in arrays.items():
+        np.save(Path(path, f'{key}.npy'), array)
+
+def load_compiled_locations(path):
+    """Returns the LocationTable with the arrays saved in the directory, memory-mapped"""
+    arrays = {}
+    for key in ['points', 'labels', 'names', 'name_points']:
+        arrays[key] = np.load(Path(path, f'{key}.npy'), mmap_mode='r')
+    return LocationTable(**arrays)
+
+def split_blob(blob):
+    """Returns the list of strings joined with newlines in the UTF-8 byte array"""
+    if len(blob) == 0:
+        return []
+    return blob.tobytes().decode('utf-8').split('\n')
+
+class LocationTable(Mapping):
+    """Read-only mapping from location name into (lat, lng, size), backed by the compiled location arrays
+
+    Each name is stored once, and the coordinates are read from the (memory-mapped) points array when looked up.
+    """
+    def __init__(self, points, labels, names, name_points):
+        self.points = points
+        self.labels = split_blob(labels)
+        self.name_points = name_points
+        self.name_ids = {name: idx for idx, name in enumerate(split_blob(names))}
+
+    def __getitem__(self, name):
+        lat, lng, size = self.points[self.name_points[self.name_ids[name]]].item()
+        return (lat, lng, size)
+
+    def __contains__(self, name):
+        return name in self.name_ids
+
+    def __iter__(self):
+        return iter(self.name_ids)
+
+    def __len__(self):
+        return len(self.name_ids)
+
+    def get_labels(self):
+        """Returns the mapping from (lat, lng) into the name to show for each point"""
+        return {(float(lat), float(lng)): label for (lat, lng, _), label in zip(self.points.tolist(), self.labels)}
@@ -13,19 +13,29 @@ import discord
 import logging
 import os
 import re
-from PIL import Image, ImageDraw
+import math
+import multiprocessing
+from PIL import Image, ImageDraw, ImageFont
 from pathlib import Path
 from io import BytesIO
-from asyncio import create_task as run, sleep
+from asyncio import create_task as run, sleep, get_running_loop, gather, ensure_future, shield, Event, wait
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import aiohttp
 import wikitextparser as WTP
 import json
-from functools import wraps
-from asyncstdlib import lru_cache
+import hashlib
+import sqlite3
+import shutil
+import numpy as np
+from functools import wraps, partial
 import time
 from datetime import datetime, timedelta
-from collections import Counter
+from collections import Counter, OrderedDict
 from verifier import Verifier, VerificationStatus
+from wikicache import WikiCache, TitleIndex, normalize_title, get_singular_plural_forms
+from recipes import RecipeGraph
+from locations import LocationIndex, FuzzyIndex, DistanceMatrix, find_short_route, get_route_length
+from locations import compile_locations, save_compiled_locations, load_compiled_locations
 
 logging.basicConfig(level=logging.INFO)
 
@@ -36,8 +46,43 @@ TOKEN = None
 
 NS_IN_S = 1_000_000_000
 
-# The max number of items to cache
-WIKI_CACHE_LIMIT = 50
+# The path to the database storing the wiki pages across restarts
+WIKI_CACHE_PATH = 'wiki_cache.sqlite3'
+# The number of seconds a cached wiki page is served before checking whether it has changed
+WIKI_CACHE_TTL = 3600
+# The number of seconds between the updates of the index of wiki page titles
+TITLE_INDEX_INTERVAL = 6 * 3600
+# The number of seconds to remember that searching a title found nothing
+TITLE_NEGATIVE_TTL = 600
+# The number of seconds between the updates of the index of the ingredients used in each recipe
+RECIPE_INDEX_INTERVAL = 24 * 3600
+# The number of seconds between the refreshes of the trading, buyer, and workshop tables
+TABLE_REFRESH_INTERVAL = 6 * 3600
+
+# The max number of bytes of rendered snapshots to cache
+SNAPSHOT_CACHE_LIMIT = 32 * 1024 * 1024
+
+# The max number of simultaneous connections to the wiki
+HTTP_CONNECTION_LIMIT = 8
+# The max number of seconds for each request to the wiki
+HTTP_TIMEOUT = 15
+# The number of seconds to cache DNS lookups
+HTTP_DNS_CACHE_TTL = 600
+
+# The directory to store the compiled location database
+LOCATION_CACHE_PATH = 'location_cache'
+
+# The directory to store rendered snapshots of named locations across restarts
+SNAPSHOT_DISK_CACHE_PATH = 'snapshot_cache'
+
+# The number of workers running CPU-bound jobs (snapshot rendering and screenshot verification)
+WORKER_COUNT = 2
+# The type of the workers, either 'thread' or 'process'
+WORKER_TYPE = 'thread'
+# How the worker processes are started. With 'spawn' they do not inherit anything from this process
+WORKER_START_METHOD = 'spawn'
+# The max number of jobs waiting for or running in the workers
+WORKER_QUEUE_LIMIT = 16
 
 class State:
     """Enumeration of Controller states"""
@@ -159,6 +204,219 @@ def privileged(f):
 
 RES_PATH = 'res'
 
+def file_digest(path):
+    """Returns the SHA-1 hex digest of the content of the file at the given path"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class Encoding:
+    """Enumeration of the image encodings of the snapshots"""
+    PNG = 'png' # Default PNG settings
+    PNG_FAST = 'png-fast' # Lowest PNG compression, for the fastest encoding
+    PNG_SMALL = 'png-small' # Highest PNG compression with optimization, for smaller uploads
+    PNG_PALETTE = 'png-palette' # PNG with colors quantized to a 256-color palette, for the smallest PNG uploads
+    WEBP = 'webp' # Lossless WebP, usually smaller than PNG
+
+    ALL = [PNG, PNG_FAST, PNG_SMALL, PNG_PALETTE, WEBP]
+
+    @staticmethod
+    def get_extension(encoding):
+        """Returns the file extension of images with the given encoding"""
+        if encoding == Encoding.WEBP:
+            return 'webp'
+        return 'png'
+
+    @staticmethod
+    def encode(image, encoding):
+        """Encodes the image with the given encoding and returns the bytes"""
+        output = BytesIO()
+        if encoding == Encoding.PNG:
+            image.save(output, format='png')
+        elif encoding == Encoding.PNG_FAST:
+            image.save(output, format='png', compress_level=1)
+        elif encoding == Encoding.PNG_SMALL:
+            image.save(output, format='png', compress_level=9, optimize=True)
+        elif encoding == Encoding.PNG_PALETTE:
+            image.quantize(256, method=Image.FASTOCTREE).save(output, format='png', optimize=True)
+        elif encoding == Encoding.WEBP:
+            image.save(output, format='webp', lossless=True)
+        else:
+            raise ValueError(f'Unknown encoding: {encoding}')
+        return output.getvalue()
+
+class EncodingStats:
+    """Keeps the count, total size and total encoding time of the snapshots, per encoding"""
+    def __init__(self):
+        self.stats = {}
+
+    def add(self, encoding, size, encode_time):
+        count, total_size, total_time = self.stats.get(encoding, (0, 0, 0))
+        self.stats[encoding] = (count+1, total_size+size, total_time+encode_time)
+
+    def get_status(self):
+        content = ''
+        for encoding, (count, total_size, total_time) in self.stats.items():
+            content += f'\n• {encoding}: {count} images, avg {total_size/count/1024:.1f} KB, avg {total_time/count*1000:.1f} ms to encode'
+        return content
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key, so that the work is done once and the result is shared"""
+    def __init__(self):
+        self.tasks = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def run(self, key, f, *args):
+        """Returns the result of awaiting f(*args), or of the call in flight with the same key if there is one
+
+        Exceptions are raised to all callers sharing the call. Cancelling one caller does not cancel the shared call.
+        """
+        self.calls += 1
+        task = self.tasks.get(key)
+        if task is None:
+            task = ensure_future(f(*args))
+            self.tasks[key] = task
+            task.add_done_callback(partial(self.remove, key))
+        else:
+            self.coalesced += 1
+        return await shield(task)
+
+    async def run_batch(self, keys, f):
+        """Returns the results for the keys, sharing the calls in flight with any of the keys,
+        and making one call to f with the list of the other keys
+
+        f must return a dictionary from key into result, and the returned dictionary contains the keys found
+        in the results of those calls.
+        """
+        self.calls += len(keys)
+        tasks = {key: self.tasks[key] for key in keys if key in self.tasks}
+        self.coalesced += len(tasks)
+        new_keys = [key for key in keys if key not in tasks]
+        if new_keys:
+            task = ensure_future(f(new_keys))
+            for key in new_keys:
+                self.tasks[key] = task
+                task.add_done_callback(partial(self.remove, key))
+                tasks[key] = task
+        unique_tasks = list(set(tasks.values()))
+        results = dict(zip(unique_tasks, await gather(*[shield(task) for task in unique_tasks])))
+        return {key: results[task][key] for key, task in tasks.items() if key in results[task]}
+
+    def remove(self, key, task):
+        if self.tasks.get(key) is task:
+            del self.tasks[key]
+
+    def get_status(self):
+        content = f'{self.calls} calls, {self.coalesced} coalesced'
+        if self.calls:
+            content = f'{content} ({self.coalesced/self.calls:.1%})'
+        return content
+
+class SnapshotCache:
+    """LRU cache of encoded snapshots, bounded by the total size of the cached images"""
+    def __init__(self, max_bytes=SNAPSHOT_CACHE_LIMIT):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the cached image bytes for the key, or None if not cached"""
+        data = self.entries.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """Stores the image bytes for the key, evicting the least recently used entries if needed"""
+        if len(data) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        self.entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def clear(self):
+        """Removes all cached images. The hit and miss counters are kept"""
+        self.entries.clear()
+        self.size = 0
+
+    def get_status(self):
+        content = f'{len(self.entries)} images, {self.size/1024/1024:.1f}/{self.max_bytes/1024/1024:.0f} MB, '
+        content = f'{content}{self.hits} hits, {self.misses} misses'
+        return content
+
+class SnapshotDiskCache:
+    """Cache of encoded snapshots on disk, which persists across restarts
+
+    The snapshots are stored in a directory named after the digest of the images they are rendered from,
+    so that changing the world map or the marker invalidates all of them.
+    """
+    def __init__(self, path=SNAPSHOT_DISK_CACHE_PATH):
+        self.path = Path(path)
+        self.directory = None
+        self.hits = 0
+        self.misses = 0
+
+    def open(self, digest):
+        """Enables the cache for snapshots rendered from images with the given digest, removing outdated snapshots
+
+        Only the directories named like a digest are removed, so that nothing else in the path is deleted.
+        """
+        self.directory = Path(self.path, digest)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for directory in self.path.iterdir():
+            if directory == self.directory or not directory.is_dir():
+                continue
+            if re.fullmatch(f'[0-9a-f]{{{len(digest)}}}', directory.name):
+                logging.info(f'Removing outdated snapshots in {directory}')
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def get_path(self, key):
+        return Path(self.directory, f'{hashlib.sha1(repr(key).encode("utf-8")).hexdigest()}.bin')
+
+    def contains(self, key):
+        return self.directory is not None and self.get_path(key).exists()
+
+    def get(self, key):
+        """Returns the cached image bytes for the key, or None if not cached or the cache is not open"""
+        if self.directory is None:
+            return None
+        try:
+            with open(self.get_path(key), 'rb') as infile:
+                data = infile.read()
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """Stores the image bytes for the key, if the cache is open"""
+        if self.directory is None:
+            return
+        path = self.get_path(key)
+        # Write to a temporary file first, so that other processes never read a partial file
+        tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as outfile:
+            outfile.write(data)
+        os.replace(tmp_path, path)
+
+    def get_status(self):
+        if self.directory is None:
+            return 'disabled'
+        return f'{self.hits} hits, {self.misses} misses'
+
 class MapController:
     """The regex recognizing URL to the interactive Day R map"""
     MAP_REGEX = 'https://dayr-map.info/(?:index\.html)?\?(?:start\=true&)?clat\=([-0-9.]+)&clng\=([-0-9.]+)(?:&mlat\=([-0-9.]+)&mlng\=([-0-9.]+))?&zoom\=([-0-9.]+)'
@@ -166,9 +424,34 @@ class MapController:
     """The URL to the interactive map"""
     MAP_URL = 'https://dayr-map.info'
 
+    """The max number of map links in a message to reply with snapshots"""
+    LINK_LIMIT = 5
+
+    """Whether to reply to multiple map links with one contact sheet image instead of one image per link"""
+    CONTACT_SHEET = False
+
     """Stores the image of the world map"""
     map_image = None
     map_path = 'world_map_biomes_cities.png'
+    map_digest = None
+
+    """Stores the downscaled copies of the world map, keyed by the zoom level they serve"""
+    pyramid = None
+
+    """The zoom levels (in half steps) at which the world map is downscaled in the pyramid.
+    From zoom 1 onwards the snapshot is taken from the full resolution world map, stored in the pyramid as zoom 1"""
+    PYRAMID_ZOOMS = [z/2 for z in range(-6, 2)]
+
+    """Stores the world map scaled down to the size of the minimap under the snapshot"""
+    minimap_image = None
+
+    """Stores the pixels of the minimap on the full snapshot canvas, to be copied for each snapshot"""
+    world_canvas = None
+
+    """How the world map is stored: 'memory' keeps the decoded images in memory, while 'mmap' keeps the raw
+    pixels in files under map_cache_path, which are memory-mapped so only the regions being cropped are loaded"""
+    map_storage = 'memory'
+    map_cache_path = 'map_cache'
 
     """Stores the image of the marker"""
     marker_image = None
@@ -177,6 +460,53 @@ class MapController:
     """Mapping of all location names into their coordinates and size"""
     locations = {}
 
+    """Mapping of location coordinates into the (English) name to show"""
+    location_labels = {}
+
+    """Spatial index over the locations"""
+    location_index = LocationIndex({})
+
+    """Index over the location names, to suggest names for misspelled locations"""
+    location_fuzzy_index = FuzzyIndex(())
+
+    """Distances between all locations"""
+    location_distances = DistanceMatrix(location_index)
+
+    """The max number of stops in a route"""
+    ROUTE_LIMIT = 25
+
+    """The max number of places listed in replies about nearby places"""
+    NEARBY_LIMIT = 20
+
+    """The number of nearest places named in the replies to map links"""
+    NEARBY_NAME_COUNT = 3
+
+    """Whether to label the named places on the snapshots of map links, and the max number of labels"""
+    LABELS = False
+    LABEL_LIMIT = 8
+
+    """Stores the font of the labels"""
+    label_font = None
+    label_font_path = 'freemono.ttf'
+
+    """Cache of the rendered snapshots"""
+    snapshot_cache = SnapshotCache()
+
+    """Cache of the rendered snapshots of named locations, persisted on disk"""
+    snapshot_disk_cache = SnapshotDiskCache()
+
+    """The snapshot renderings in progress"""
+    snapshot_flight = SingleFlight()
+
+    """Whether to render the snapshots of all named locations in the background after starting"""
+    PREWARM = False
+
+    """The image encoding of the snapshots, one of Encoding.ALL"""
+    encoding = Encoding.PNG
+
+    """The size and encoding time of the rendered snapshots"""
+    encoding_stats = EncodingStats()
+
     """Controller for messages containing URL to the interactive Day R map
     """
     def __init__(self, clat, clng, zoom=0, mlat=None, mlng=None, start=False):
@@ -189,67 +519,176 @@ class MapController:
 
         self.has_marker = self.mlat is not None
 
+        # The named places to label on the snapshot, as (lat, lng, label)
+        self.labels = ()
+
     def __repr__(self):
         return f'clat: {self.clat}, clng: {self.clng}, mlat: {self.mlat}, mlng: {self.mlng}, zoom: {self.zoom}'
 
     __str__ = __repr__
 
-    async def generate_snapshot(self, include_world=True):
+    async def generate_snapshot(self, include_world=True, persist=False):
         """Generate a snapshot for this location.
 
         include_world: If True, will include the world map at the bottom as the bigger picture
+        persist: If True, will also look up and store the snapshot in the disk cache
+        """
+        encoding = MapController.encoding
+        key = self.get_cache_key(include_world, encoding)
+        data = MapController.snapshot_cache.get(key)
+        if data is None:
+            # Concurrent requests for the same snapshot wait for the same rendering
+            data = await MapController.snapshot_flight.run(key, self.load_snapshot, key, include_world, encoding, persist)
+        return BytesIO(data)
+
+    async def load_snapshot(self, key, include_world, encoding, persist):
+        """Load the snapshot from the disk cache or render it, and store it in the caches
+        """
+        data = None
+        if persist:
+            data = MapController.snapshot_disk_cache.get(key)
+        if data is None:
+            data = await self.render(include_world, encoding)
+            if persist:
+                MapController.snapshot_disk_cache.put(key, data)
+        MapController.snapshot_cache.put(key, data)
+        return data
+
+    async def render(self, include_world, encoding):
+        """Render the snapshot in a worker and return the encoded bytes, recording the size and encoding time
+        """
+        data, encode_time = await worker_pool.run(self.render_snapshot, include_world, encoding)
+        MapController.encoding_stats.add(encoding, len(data), encode_time)
+        logging.info(f'Encoded snapshot {self.get_id()} as {encoding}: {len(data)} bytes in {encode_time*1000:.1f}ms')
+        return data
+
+    def get_cache_key(self, include_world, encoding):
+        """Get the key of the snapshot of this location in the snapshot caches"""
+        return (self.get_id(), self.zoom, include_world, encoding, self.labels)
+
+    def get_filename(self):
+        """Get the file name of the snapshot of this location"""
+        return f'snapshot_{self.get_id()}.{Encoding.get_extension(MapController.encoding)}'
+
+    def render_snapshot(self, include_world=True, encoding=Encoding.PNG):
+        """Render the snapshot for this location and return the encoded bytes, along with the encoding time in seconds.
+
+        include_world: If True, will include the world map at the bottom as the bigger picture
+        encoding: The image encoding, one of Encoding.ALL
         """
         if self.has_marker:
             y, x = -self.mlat, self.mlng
         else:
             y, x = -self.clat, self.clng
         zoom = self.zoom
-        world = MapController.get_world_image()
         top, bottom = y - 256/(2**zoom), y + 256/(2**zoom)
         left, right = x - 256/(2**zoom), x + 256/(2**zoom)
         logging.info(f'Cropping world at {left} {top} {right} {bottom}')
-        snapshot = world.crop((left, top, right, bottom))
-        if top - bottom <= 256:
+        level, scale_x, scale_y = MapController.get_pyramid_level(zoom)
+        snapshot = MapController.crop(level, (left*scale_x, top*scale_y, right*scale_x, bottom*scale_y))
+        if snapshot.size != (256, 256):
+            # Only happens when zooming in further than the full resolution, or at non-standard zoom
             snapshot = snapshot.resize((256, 256), resample=Image.NEAREST)
-        else:
-            snapshot = snapshot.resize((256, 256), resample=Image.BILINEAR)
+
+        if self.labels:
+            self.draw_labels(snapshot, left, top, right, bottom)
 
         if self.has_marker:
             marker = MapController.get_marker_image()
             snapshot.paste(marker, (112, 96), marker.getchannel('A'))
 
         if include_world:
-            # Expand the canvas and put the world map under the inset
-            result = Image.new('RGBA', (256, 400))
-            result.paste(snapshot)
-            result.paste(world.resize((256, 144)), (0, 256))
+            # Put the snapshot above the world map on a copy of the prepared canvas
+            canvas = MapController.get_world_canvas().copy()
+            canvas[:256] = np.asarray(snapshot)
+            world = canvas[256:]
 
             # Draw a marker at the same place at the world map
             if self.has_marker:
-                result.paste(marker, (int(x//32)-16, int(y//32)-32+256), marker.getchannel('A'))
-
-            # Draw an overlay indicating the inset on the world map
-            overlay = Image.new('RGBA', (256, 400))
-            draw = ImageDraw.Draw(overlay)
-            fill_color = (255, 255, 0, 64) # Transparent yellow
-            outline_color = (255, 255, 0, 96) # More solid yellow
-            draw.rectangle((max(0, int(left//32)),
-                            max(0, int(top//32))+256,
-                            min(256, int(right//32)),
-                            min(144, int(bottom//32))+256),
-                           fill=fill_color,
-                           outline=outline_color,
-                           width=1)
-            draw.line((0, 256, max(0, int(left//32)), min(144, int(bottom//32))+256), (255, 255, 0, 96), 1)
-            draw.line((256, 256, min(256, int(right//32)), min(144, int(bottom//32))+256), (255, 255, 0, 96), 1)
-            result = Image.alpha_composite(result, overlay)
+                MapController.paste_pixels(canvas, np.asarray(marker), int(x//32)-16, int(y//32)-32+256)
+
+            # Draw an overlay indicating the inset on the world map, only on the pixels it covers
+            overlay = np.zeros(world.shape[:2], dtype=np.uint8)
+            fill_alpha = 64 # Transparent yellow
+            outline_alpha = 96 # More solid yellow
+            x0, y0 = max(0, int(left//32)), max(0, int(top//32))
+            x1, y1 = min(256, int(right//32)), min(144, int(bottom//32))
+            overlay[y0:y1+1, x0:x1+1] = fill_alpha
+            for row in (y0, y1):
+                if row < 144:
+                    overlay[row, x0:x1+1] = outline_alpha
+            for col in (x0, x1):
+                if col < 256:
+                    overlay[y0:y1+1, col] = outline_alpha
+            MapController.draw_line(overlay, (0, 0, x0, y1), outline_alpha)
+            MapController.draw_line(overlay, (256, 0, x1, y1), outline_alpha)
+            MapController.blend_color(world, overlay, (255, 255, 0))
+            result = Image.fromarray(canvas)
         else:
             result = snapshot
-        
-        output = BytesIO()
-        result.save(output, format='png')
-        output.seek(0)
-        return output
+
+        start_time = time.perf_counter()
+        data = Encoding.encode(result, encoding)
+        return data, time.perf_counter()-start_time
+
+    def draw_labels(self, snapshot, left, top, right, bottom):
+        """Draw a dot and the name of each labelled place on the snapshot covering the given area of the world map"""
+        draw = ImageDraw.Draw(snapshot)
+        font = MapController.get_label_font()
+        for lat, lng, label in self.labels:
+            px = (lng-left)*snapshot.width/(right-left)
+            py = (-lat-top)*snapshot.height/(bottom-top)
+            draw.ellipse((px-2, py-2, px+2, py+2), fill=(255, 255, 255, 255), outline=(0, 0, 0, 255))
+            text_width = draw.textlength(label, font=font)
+            text_x = min(px+4, snapshot.width-text_width)
+            draw.text((text_x, py), label, font=font, anchor='lm', fill=(255, 255, 255, 255),
+                      stroke_width=2, stroke_fill=(0, 0, 0, 255))
+
+    def get_position(self):
+        """Get the (lat, lng) shown at the center of the snapshot, which is the marker if there is one"""
+        if self.has_marker:
+            return self.mlat, self.mlng
+        return self.clat, self.clng
+
+    def find_labels(self):
+        """Set the labels of this snapshot to the biggest named places inside the area shown"""
+        lat, lng = self.get_position()
+        radius = 256/(2**self.zoom)
+        index = MapController.location_index
+        points = [index.points[idx] for idx in index.within_box(lat-radius, lng-radius, lat+radius, lng+radius)]
+        points.sort(key=lambda point: -point[2])
+        self.labels = tuple((lat, lng, label) for lat, lng, size, label, names in points[:MapController.LABEL_LIMIT])
+
+    def get_nearby_str(self):
+        """Get the description of the named places nearest to the location shown in the snapshot"""
+        places = MapController.location_index.nearest(*self.get_position(), MapController.NEARBY_NAME_COUNT)
+        if not places:
+            return ''
+        return 'near ' + ', '.join(f'{label} ({distance:.0f}km)' for distance, (_, _, _, label, _) in places)
+
+    @classmethod
+    def get_label_font(cls):
+        """Returns the font of the labels
+
+        This method caches the result the first time it is called.
+        """
+        if cls.label_font is None:
+            cls.label_font = ImageFont.truetype(str(Path(RES_PATH, cls.label_font_path)), size=12)
+        return cls.label_font
+
+    @staticmethod
+    def render_contact_sheet(images, encoding=Encoding.PNG, columns=5):
+        """Arrange the encoded snapshots in a grid and return the encoded bytes of the resulting image
+        """
+        images = [Image.open(BytesIO(image)) for image in images]
+        columns = min(columns, len(images))
+        rows = (len(images)+columns-1) // columns
+        width = max(image.width for image in images)
+        height = max(image.height for image in images)
+        result = Image.new('RGBA', (columns*width, rows*height))
+        for idx, image in enumerate(images):
+            result.paste(image, ((idx % columns)*width, (idx // columns)*height))
+        return Encoding.encode(result, encoding)
 
     def is_valid(self, strict=False):
         if self.clat > 0 or self.clat < -9*512:
@@ -279,11 +718,19 @@ class MapController:
 
     def get_id(self):
         """Get the id of this map controller"""
-        if self.mlat:
+        if self.has_marker:
             return f'm{-self.mlat}_{self.mlng}'
         else:
             return f'{-self.clat}_{self.clng}'
 
+    def get_location_str(self):
+        """Get the description of the location shown in the snapshot"""
+        snapshot_id = self.get_id().replace('_', ', ')
+        if snapshot_id[0] == 'm':
+            return f'marker at -{snapshot_id[1:]}'
+        else:
+            return f'center at -{snapshot_id}'
+
     @staticmethod
     def from_match(match):
         """Create an instance of a map controller based on the regex match object"""
@@ -299,15 +746,245 @@ class MapController:
 
     @classmethod
     def get_world_image(cls):
-        """Returns the world map image
+        """Returns the world map image, in RGB mode unless it has transparent pixels
 
         This method caches the result the first time it is called.
         """
         if cls.map_image is None:
             with open(str(Path(RES_PATH, cls.map_path)), 'rb') as infile:
-                cls.map_image = Image.open(infile).convert('RGBA')
+                image = Image.open(infile).convert('RGBA')
+            if image.getchannel('A').getextrema() == (255, 255):
+                image = image.convert('RGB')
+            cls.map_image = image
         return cls.map_image
 
+    @classmethod
+    def compile_locations(cls, location_path, cache_path=LOCATION_CACHE_PATH):
+        """Compiles the location marker data into the binary location database, unless it is up to date
+
+        Returns True if the database was (re)compiled.
+        """
+        digest = file_digest(location_path)
+        meta_path = Path(cache_path, 'meta.json')
+        try:
+            with open(meta_path, 'r') as infile:
+                if json.load(infile)['digest'] == digest:
+                    return False
+        except (OSError, ValueError, KeyError):
+            pass
+        logging.info(f'Compiling {location_path} into {cache_path}')
+        with open(location_path, 'r') as infile:
+            location_data = json.load(infile)
+        save_compiled_locations(compile_locations(location_data), cache_path)
+        # Written last, so that an interrupted compilation is redone
+        with open(meta_path, 'w') as outfile:
+            json.dump({'digest': digest}, outfile)
+        return True
+
+    @classmethod
+    def load_locations(cls, location_path, cache_path=LOCATION_CACHE_PATH):
+        """Loads the locations from the binary location database, compiling it first if needed, and builds the indices
+        """
+        cls.compile_locations(location_path, cache_path)
+        cls.locations = load_compiled_locations(cache_path)
+        cls.location_labels = cls.locations.get_labels()
+        cls.location_index = LocationIndex(cls.locations, cls.location_labels)
+        cls.location_fuzzy_index = FuzzyIndex(cls.locations)
+        cls.location_distances = DistanceMatrix(cls.location_index)
+
+    @classmethod
+    def get_map_digest(cls):
+        """Returns the digest of the world map file
+
+        This method caches the result the first time it is called.
+        """
+        if cls.map_digest is None:
+            cls.map_digest = file_digest(Path(RES_PATH, cls.map_path))
+        return cls.map_digest
+
+    @classmethod
+    def get_assets_digest(cls):
+        """Returns the digest of all images used to render the snapshots"""
+        marker_digest = file_digest(Path(RES_PATH, cls.marker_path))
+        return hashlib.sha1(f'{cls.get_map_digest()}_{marker_digest}'.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def get_pyramid(cls):
+        """Returns the image pyramid of the world map, as a mapping from zoom level to image
+
+        Each level is downscaled such that cropping the area shown at that zoom gives a 256x256 image.
+        With the 'mmap' storage, the levels are memory-mapped arrays of pixels instead of images.
+        This method caches the result the first time it is called.
+        """
+        if cls.pyramid is None:
+            if cls.map_storage == 'mmap':
+                cls.pyramid = cls.load_map_cache()
+            else:
+                cls.pyramid = cls.build_pyramid(cls.get_world_image())
+        return cls.pyramid
+
+    @classmethod
+    def build_pyramid(cls, world):
+        """Returns the image pyramid of the given world map image, with the levels in the mode of the image"""
+        pyramid = {}
+        for zoom in cls.PYRAMID_ZOOMS:
+            scale = 2**(zoom-1)
+            size = (round(world.width*scale), round(world.height*scale))
+            pyramid[zoom] = world.resize(size, resample=Image.NEAREST)
+        pyramid[1] = world
+        return pyramid
+
+    @classmethod
+    def get_pyramid_level(cls, zoom):
+        """Returns the image to crop the snapshot at the given zoom from, and its scale (x and y) relative to the world map
+
+        This picks the coarsest level that still has at least the required resolution.
+        """
+        pyramid = cls.get_pyramid()
+        levels = [level_zoom for level_zoom in pyramid if level_zoom >= zoom]
+        level = pyramid[min(levels) if levels else 1]
+        width, height = MapController.get_size(level)
+        world_width, world_height = MapController.get_size(pyramid[1])
+        return level, width/world_width, height/world_height
+
+    @staticmethod
+    def get_size(image):
+        """Returns the (width, height) of the image, which is either a PIL image or an array of pixels"""
+        if isinstance(image, Image.Image):
+            return image.size
+        return image.shape[1], image.shape[0]
+
+    @staticmethod
+    def crop(image, box):
+        """Crops the box (left, top, right, bottom) from the image, which is either a PIL image or an array of pixels
+
+        The result is an RGBA image. Same as in PIL, the box is rounded to whole pixels and the area outside of
+        the image is transparent. Only the pages of a memory-mapped array covering the box are read.
+        """
+        if isinstance(image, Image.Image) and image.mode == 'RGBA':
+            return image.crop(box)
+        left, top, right, bottom = (int(round(v)) for v in box)
+        if isinstance(image, Image.Image):
+            result = Image.new('RGBA', (right-left, bottom-top))
+            width, height = image.size
+            src_box = (max(left, 0), max(top, 0), min(right, width), min(bottom, height))
+            if src_box[0] < src_box[2] and src_box[1] < src_box[3]:
+                result.paste(image.crop(src_box), (src_box[0]-left, src_box[1]-top))
+            return result
+        height, width, channels = image.shape
+        result = np.zeros((bottom-top, right-left, 4), dtype=np.uint8)
+        src_left, src_top = max(left, 0), max(top, 0)
+        src_right, src_bottom = min(right, width), min(bottom, height)
+        if src_left < src_right and src_top < src_bottom:
+            region = result[src_top-top:src_bottom-top, src_left-left:src_right-left]
+            region[..., :channels] = image[src_top:src_bottom, src_left:src_right]
+            if channels == 3:
+                region[..., 3] = 255
+        return Image.fromarray(result)
+
+    @classmethod
+    def get_world_canvas(cls):
+        """Returns the 256x400 RGBA pixels with the world minimap at the bottom and the top left empty for the snapshot
+
+        This method caches the result the first time it is called. Copy it before drawing on it.
+        """
+        if cls.world_canvas is None:
+            canvas = np.zeros((400, 256, 4), dtype=np.uint8)
+            canvas[256:] = np.asarray(cls.get_minimap_image())
+            canvas.flags.writeable = False
+            cls.world_canvas = canvas
+        return cls.world_canvas
+
+    @staticmethod
+    def paste_pixels(pixels, image, left, top):
+        """Pastes the RGBA image pixels onto the RGBA pixels at the given position, using the image alpha as mask
+
+        Similar to Image.paste with a mask, the part outside of the pixels is dropped.
+        """
+        height, width = pixels.shape[:2]
+        x0, y0 = max(left, 0), max(top, 0)
+        x1, y1 = min(left+image.shape[1], width), min(top+image.shape[0], height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        source = image[y0-top:y1-top, x0-left:x1-left].astype(np.float32)
+        target = pixels[y0:y1, x0:x1]
+        mask = source[..., 3:]/255
+        target[...] = np.rint(source*mask + target*(1-mask))
+
+    @staticmethod
+    def draw_line(mask, line, value):
+        """Sets the pixels of the mask on the 1-pixel wide line (x0, y0, x1, y1) to the value, clipped to the mask"""
+        x0, y0, x1, y1 = line
+        count = max(abs(x1-x0), abs(y1-y0)) + 1
+        xs = np.rint(np.linspace(x0, x1, count)).astype(int)
+        ys = np.rint(np.linspace(y0, y1, count)).astype(int)
+        inside = (xs >= 0) & (xs < mask.shape[1]) & (ys >= 0) & (ys < mask.shape[0])
+        mask[ys[inside], xs[inside]] = value
+
+    @staticmethod
+    def blend_color(pixels, alpha, color):
+        """Alpha-composites the RGB color with the per-pixel alpha over the RGBA pixels, only where alpha is non-zero"""
+        selected = alpha > 0
+        target = pixels[selected].astype(np.float32)/255
+        source_alpha = alpha[selected, np.newaxis].astype(np.float32)/255
+        target_alpha = target[:, 3:]
+        result_alpha = source_alpha + target_alpha*(1-source_alpha)
+        result_color = (np.array(color, dtype=np.float32)/255*source_alpha
+                        + target[:, :3]*target_alpha*(1-source_alpha))/result_alpha
+        pixels[selected] = np.rint(np.concatenate([result_color, result_alpha], axis=1)*255)
+
+    @classmethod
+    def get_minimap_image(cls):
+        """Returns the world map scaled down to 256x144
+
+        This method caches the result the first time it is called.
+        """
+        if cls.minimap_image is None:
+            if cls.map_storage == 'mmap':
+                with open(cls.get_map_cache_path('minimap.png'), 'rb') as infile:
+                    cls.minimap_image = Image.open(infile).convert('RGBA')
+            else:
+                cls.minimap_image = cls.get_world_image().resize((256, 144)).convert('RGBA')
+        return cls.minimap_image
+
+    @classmethod
+    def get_map_cache_path(cls, name):
+        return Path(RES_PATH, cls.map_cache_path, name)
+
+    @classmethod
+    def update_map_cache(cls):
+        """Writes the pyramid levels and the minimap for the 'mmap' storage, unless they are up to date with the world map
+
+        The levels are stored as .npy files of RGB pixels (RGBA only if the world map has transparent pixels).
+        """
+        digest = cls.get_map_digest()
+        meta_path = cls.get_map_cache_path('meta.json')
+        try:
+            with open(meta_path, 'r') as infile:
+                if json.load(infile)['digest'] == digest:
+                    return
+        except (OSError, ValueError, KeyError):
+            pass
+        logging.info(f'Building world map cache at {meta_path.parent}')
+        meta_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(str(Path(RES_PATH, cls.map_path)), 'rb') as infile:
+            world = Image.open(infile).convert('RGBA')
+        mode = 'RGB' if world.getchannel('A').getextrema() == (255, 255) else 'RGBA'
+        for zoom, level in cls.build_pyramid(world).items():
+            np.save(cls.get_map_cache_path(f'level_{zoom}.npy'), np.asarray(level.convert(mode)))
+        world.resize((256, 144)).save(cls.get_map_cache_path('minimap.png'))
+        # Written last, so that an interrupted build is redone
+        with open(meta_path, 'w') as outfile:
+            json.dump({'digest': digest}, outfile)
+
+    @classmethod
+    def load_map_cache(cls):
+        """Returns the image pyramid with each level memory-mapped from the map cache"""
+        pyramid = {}
+        for zoom in cls.PYRAMID_ZOOMS + [1]:
+            pyramid[zoom] = np.load(cls.get_map_cache_path(f'level_{zoom}.npy'), mmap_mode='r')
+        return pyramid
+
     @classmethod
     def get_marker_image(cls):
         """Returns the marker image
@@ -319,9 +996,100 @@ class MapController:
                 cls.marker_image = Image.open(infile).convert('RGBA').resize((32, 32))
         return cls.marker_image
 
+class WorkerPoolFull(Exception):
+    """Raised when there are too many jobs waiting for the workers"""
+    pass
+
+class PageParseError(Exception):
+    """Raised when the data cannot be extracted from the wikitext of a page"""
+    pass
+
+def get_worker_settings():
+    """Returns the settings of this process needed by the jobs, to be applied in the worker processes"""
+    return {
+        'res_path': RES_PATH,
+        'map_storage': MapController.map_storage,
+        'encoding': MapController.encoding,
+        'verifier_threshold': controller.verifier.threshold,
+        }
+
+def init_worker(settings=None):
+    """Loads the resources needed by the jobs, so that they are not sent with every job
+
+    In a worker process, the settings from get_worker_settings() are applied first.
+    """
+    global RES_PATH
+    if settings is not None:
+        RES_PATH = settings['res_path']
+        MapController.map_storage = settings['map_storage']
+        MapController.encoding = settings['encoding']
+        controller.verifier.threshold = settings['verifier_threshold']
+    MapController.get_pyramid()
+    MapController.get_world_canvas()
+    MapController.get_marker_image()
+    MapController.get_label_font()
+
+def verify_screenshot(image, username):
+    """Runs the screenshot verification. The verifier templates are created when this module is loaded
+    """
+    return controller.verifier.verify(image, username)
+
+class WorkerPool:
+    """Runs CPU-bound jobs outside of the event loop, with a bound on the number of pending jobs"""
+    def __init__(self):
+        self.executor = None
+        self.queue_limit = WORKER_QUEUE_LIMIT
+        self.pending = 0
+
+    def start(self, workers=WORKER_COUNT, worker_type=WORKER_TYPE, queue_limit=WORKER_QUEUE_LIMIT,
+              start_method=WORKER_START_METHOD):
+        """Starts the workers. Each worker loads the world map and the marker once at startup
+        """
+        self.queue_limit = queue_limit
+        if worker_type == 'process':
+            self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context(start_method),
+                                                initializer=init_worker, initargs=(get_worker_settings(),))
+        elif worker_type == 'thread':
+            # Threads share the resources of this process, so just load them here
+            init_worker()
+            self.executor = ThreadPoolExecutor(workers, thread_name_prefix='worker')
+        else:
+            raise ValueError(f'Unknown worker type: {worker_type}')
+        logging.info(f'Started {workers} {worker_type} workers')
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    async def run(self, f, *args):
+        """Runs f(*args) in a worker and returns the result
+
+        Raises WorkerPoolFull if there are already too many pending jobs.
+        """
+        if self.executor is None:
+            self.start()
+        if self.pending >= self.queue_limit:
+            raise WorkerPoolFull()
+        self.pending += 1
+        try:
+            return await get_running_loop().run_in_executor(self.executor, partial(f, *args))
+        finally:
+            self.pending -= 1
+
+    def get_status(self):
+        return f'{self.pending}/{self.queue_limit} pending jobs'
+
+worker_pool = WorkerPool()
+
 intents = discord.Intents.default()
 intents.message_content = True
-client = discord.Client(intents=intents)
+class Client(discord.Client):
+    async def close(self):
+        await Controller.close_session()
+        await super().close()
+
+client = Client(intents=intents)
 
 async def wait_until(dt):
     """Sleep until the specified datetime"""
@@ -349,22 +1117,125 @@ async def schedule_activity():
     await wait_until(controller.scheduled_activity_date)
     await client.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name='for ~command'))
 
+async def schedule_title_index():
+    """Schedule updating the index of wiki page titles periodically"""
+    if controller.title_index_scheduled:
+        return
+    controller.title_index_scheduled = True
+    while True:
+        try:
+            await Controller.update_title_index()
+        except Exception as e:
+            # Keep the previous index, and search the wiki for the titles not found in it
+            logging.error(f'Cannot update the title index: {e}')
+        Controller.title_index_ready.set()
+        await sleep(Controller.TITLE_INDEX_INTERVAL)
+
+async def schedule_recipe_index():
+    """Schedule updating the index of the ingredients used in each recipe periodically"""
+    if controller.recipe_index_scheduled:
+        return
+    controller.recipe_index_scheduled = True
+    # The ingredients are resolved into page titles with the title index
+    await Controller.title_index_ready.wait()
+    while True:
+        try:
+            await Controller.recipe_index_flight.run('recipe_index', Controller.update_recipe_index)
+        except Exception as e:
+            logging.error(f'Cannot update the recipe index: {e}')
+        await sleep(Controller.RECIPE_INDEX_INTERVAL)
+
+async def schedule_tables():
+    """Schedule refreshing the trading, buyer, and workshop tables periodically"""
+    if controller.tables_scheduled:
+        return
+    controller.tables_scheduled = True
+    # The first load may use the cached pages, to be ready quickly
+    await Controller.table_flight.run('tables', controller.refresh_tables, False)
+    while True:
+        await sleep(Controller.TABLE_REFRESH_INTERVAL)
+        await controller.refresh_tables()
+
+async def prewarm_snapshots():
+    """Render the snapshots shown by the location command into the disk cache, while the workers are idle"""
+    if controller.prewarm_started:
+        return
+    controller.prewarm_started = True
+    coordinates = sorted(set((lat, lng) for lat, lng, size in MapController.locations.values()))
+    logging.info(f'Prewarming snapshots of {len(coordinates)} locations')
+    count = 0
+    for lat, lng in coordinates:
+        map_controller = MapController(lat, lng, 1, lat, lng)
+        key = map_controller.get_cache_key(True, MapController.encoding)
+        if MapController.snapshot_disk_cache.contains(key):
+            continue
+        # Low priority: wait until no other job is using the workers
+        while worker_pool.pending > 0:
+            await sleep(1)
+        try:
+            data = await map_controller.render(True, MapController.encoding)
+        except WorkerPoolFull:
+            continue
+        MapController.snapshot_disk_cache.put(key, data)
+        count += 1
+    logging.info(f'Prewarmed {count} snapshots')
+
 @client.event
 async def on_ready():
     print(f'We have logged in as {client.user}')
     run(schedule_status())
     run(schedule_activity())
+    run(schedule_title_index())
+    run(schedule_recipe_index())
+    run(schedule_tables())
+    if MapController.PREWARM:
+        run(prewarm_snapshots())
+
+def normalize_item_name(name):
+    """Returns the key used to look up the item name: lowercase, with single spaces"""
+    return ' '.join(name.lower().split())
+
+def get_item_aliases(name):
+    """Returns the keys of the items the user may refer to with the name, such as its plural or singular form"""
+    key = normalize_item_name(name)
+    aliases = [key, f'{key}s']
+    if key.endswith('s'):
+        aliases.append(key[:-1])
+    aliases.append(f'{key} metal')
+    aliases.append(f'sulfuric {key}')
+    return aliases
+
+class ItemIndex:
+    """Inverted index from the key of each item name into the entries (trades, prices, or crafts) of that item"""
+    def __init__(self):
+        self.entries = {}
+        self.count = 0
+
+    def add(self, name, entry):
+        self.entries.setdefault(normalize_item_name(name), []).append((self.count, entry))
+        self.count += 1
+
+    def lookup(self, name):
+        """Returns the entries of all items the name may refer to, in the order they were added"""
+        found = []
+        for alias in get_item_aliases(name):
+            found.extend(self.entries.get(alias, []))
+        found.sort(key=lambda item: item[0])
+        return [entry for _, entry in found]
 
 class Controller:
     # The list of supported commands, mapped to its description
     commands = {
             'help': ('', '❓ Show this help (and other bots\' help message too)', True, True, 0),
             'link': ('itemName', '🔗 Show the wikilink for the specified item', True, True, 10),
-            'recipe': ('itemName', '📜 Show the recipe for the specified item', True, True, 10),
+            'recipe': ('("tree") itemName (quantity)',
+                ('📜 Show the recipe for the specified item\n'
+                +'\tIf "tree" is specified (without quotes) the sub-recipes are shown as well, with the total raw materials needed'), True, True, 10),
             'info': ('itemName', '🔍 Show the infobox for the specified item', True, True, 10),
             'trader': ('(itemName|placeName)', '🏛️ Show where we can buy the specified item or at the specified place', True, True, 10),
             'buyer': ('itemName', '💰 Show the sell price of the specified item', True, True, 10),
             'buyers': ('itemName (itemName)+', '💰 Show the sell price of multiple items (up to 10)', True, True, 10),
+            'uses': ('itemName', '⚗️ Show the items crafted with the specified item', True, True, 10),
             'workshop': ('(itemName|placeName)', '🛠️ Show where we can craft the specified item or at the specified place', True, True, 10),
             'snapshot': ('("world") ("marker") lat lng (zoom)',
                 ('📸 Show a snapshot of the map at the specified location and zoom (-3 to 5).\n'
@@ -372,6 +1243,11 @@ class Controller:
                 +'\tIf "marker" is specified (without quotes) a marker will be shown'), True, True, 60),
             'location': ('placeName', '📍 Show the location details of the specified place', True, True, 60),
             'distance': ('"place1" "place2"', '📐 Calculate the distance between the two places', True, True, 10),
+            'route': ('("best") "place1" "place2" ("place3")*',
+                ('🛣️ Calculate the distance of a trip through the places in the given order (up to 25 places).\n'
+                +'\tIf "best" is specified (without quotes) a short order to visit all places is found, starting from place1'), True, True, 10),
+            'nearest': ('lat lng (k)', '🧭 Show the k (default 5) named places nearest to the specified location', True, True, 10),
+            'around': ('placeName (radius)', '🏘️ Show the named places within the radius (default 100km) of the specified place', True, True, 10),
 
             # Hidden commands below
             'verifyme': ('ingameName', '🛂 Do automatic verification for Day R International server', True, False, 60),
@@ -381,6 +1257,7 @@ class Controller:
             'set_key': ('regex (help_key)', '🗝️ Change the trigger key (and the text in help message)', False, True, 3),
             'set_activity': ('activity', '⚽ Set the bot\'s activity', False, True, 3),
             'clear_cache': ('', '🧹 Clear the cache', False,  True, 3),
+            'set_encoding': (f'[{"|".join(Encoding.ALL)}]', '🖼️ Change the image encoding of the snapshots', False, True, 3),
             'status': ('', 'ℹ️ Show the status of the bot', False, True, 3),
             'restate': ('[Normal|Trusted|Sudo]', '🔧 Change the state of the bot', False, True, 3),
             'manage': ('[add|remove] [BANNED_USERS|TRUSTED_USERS|TRUSTED_ROLES|SUDO_IDS|SUDO_CHANNELS] ENTITYID (ENTITYID)*',
@@ -396,8 +1273,19 @@ class Controller:
     prev_help = None
 
     # The URL to wiki API
-    WIKI_API_REV_URL = 'https://dayr.fandom.com/api.php?action=query&prop=revisions&rvprop=content&format=json&rvslots=main&titles='
-    WIKI_API_SEARCH_URL = 'https://dayr.fandom.com/api.php?action=query&list=search&utf8=&format=json&srlimit=3&srprop=timestamp&srsearch='
+    WIKI_API_REV_URL = 'https://dayr.fandom.com/api.php?action=query&prop=revisions&rvprop=content|ids&format=json&rvslots=main&redirects=1'
+    WIKI_API_INFO_URL = 'https://dayr.fandom.com/api.php?action=query&prop=info&format=json&redirects=1'
+    # The max number of titles the wiki API accepts in one request
+    WIKI_BATCH_LIMIT = 50
+    # The pages with the tables used by trader, buyer, and workshop commands, fetched together
+    TABLE_PAGES = ['Trading', 'Buyer', 'Specialist']
+    TABLE_REFRESH_INTERVAL = TABLE_REFRESH_INTERVAL
+    # Coalesces the loads of the tables by the first users before the table refresher loads them
+    table_flight = SingleFlight()
+    WIKI_API_SEARCH_URL = 'https://dayr.fandom.com/api.php?action=query&list=search&utf8=&format=json&srlimit=3&srprop=timestamp'
+    WIKI_API_ALLPAGES_URL = 'https://dayr.fandom.com/api.php?action=query&list=allpages&apnamespace=0&apfilterredir=nonredirects&aplimit=max&format=json'
+    WIKI_API_EMBEDDEDIN_URL = 'https://dayr.fandom.com/api.php?action=query&list=embeddedin&einamespace=0&eilimit=max&format=json'
+    WIKI_API_REDIRECTS_URL = 'https://dayr.fandom.com/api.php?action=query&generator=allpages&gapnamespace=0&gapfilterredir=redirects&gaplimit=max&redirects=1&format=json'
 
     # Verifier settings
     VERIFIER_THRESHOLD = 0.70
@@ -411,6 +1299,38 @@ class Controller:
 
     GUILD = None
 
+    """The HTTP session shared by all requests to the wiki, to reuse the connections"""
+    session = None
+    HTTP_CONNECTION_LIMIT = HTTP_CONNECTION_LIMIT
+    HTTP_TIMEOUT = HTTP_TIMEOUT
+
+    """The wikitext of the pages fetched so far, which persists across restarts"""
+    wiki_cache = WikiCache()
+    WIKI_CACHE_TTL = WIKI_CACHE_TTL
+    revalidating = set()
+
+    """Coalesces the concurrent fetches of the same wiki page and the concurrent searches of the same title"""
+    wiki_flight = SingleFlight()
+    search_flight = SingleFlight()
+
+    """The titles of all wiki pages and redirects, to resolve titles without searching the wiki"""
+    title_index = TitleIndex()
+    # Set once the first update of the title index is done (or has failed)
+    title_index_ready = Event()
+    TITLE_INDEX_INTERVAL = TITLE_INDEX_INTERVAL
+    TITLE_NEGATIVE_TTL = TITLE_NEGATIVE_TTL
+
+    """The crafting recipes of the items looked at so far, to expand recipe trees"""
+    recipe_graph = RecipeGraph()
+    RECIPE_TREE_DEPTH = 8
+    RECIPE_TREE_LIMIT = 200
+    # The templates used by the crafting recipes, to find all pages with a recipe
+    RECIPE_TEMPLATES = ['Template:Recipe', 'Template:RecipeSpecialist']
+    RECIPE_INDEX_INTERVAL = RECIPE_INDEX_INTERVAL
+    recipe_index_updated = None
+    # Runs one update of the recipe index at a time
+    recipe_index_flight = SingleFlight()
+
     @staticmethod
     def get_args(msg):
         """Parse the message which has been determined to have DIRECT intent
@@ -452,11 +1372,22 @@ class Controller:
         self.start_time = datetime.utcnow()
         self.reply_count = 0
         self.reply_counts = Counter()
+        # The tables are None until loaded, and are replaced by the table refresher
         self.trading_table = None
+        self.trading_index = ItemIndex()
         self.buyer_table = None
+        self.buyer_index = ItemIndex()
         self.workshop_table = None
+        self.workshop_index = ItemIndex()
+        self.tables_updated = None
+        # The names of the tables that could not be refreshed the last time
+        self.table_errors = []
+        self.tables_scheduled = False
         self.scheduled_status_date = None
         self.scheduled_activity_date = None
+        self.prewarm_started = False
+        self.title_index_scheduled = False
+        self.recipe_index_scheduled = False
         self.author_dm = None
         self.verifier = Verifier('res/freemono.ttf', threshold=Controller.VERIFIER_THRESHOLD)
 
@@ -468,43 +1399,221 @@ class Controller:
         expiry = self.user_limit[command].get(msg.author.id, 0)
         return now > expiry, expiry-now
 
-    @staticmethod
-    async def http_get(url):
-        """Asynchronous method to fetch a URL"""
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as r:
-                return await r.text()
+    @classmethod
+    def get_session(cls):
+        """Returns the shared HTTP session, creating it if it is not open
+
+        This needs to be called within the event loop.
+        """
+        if cls.session is None or cls.session.closed:
+            connector = aiohttp.TCPConnector(limit=cls.HTTP_CONNECTION_LIMIT, ttl_dns_cache=HTTP_DNS_CACHE_TTL)
+            timeout = aiohttp.ClientTimeout(total=cls.HTTP_TIMEOUT)
+            cls.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return cls.session
+
+    @classmethod
+    async def close_session(cls):
+        if cls.session is not None and not cls.session.closed:
+            await cls.session.close()
+        cls.session = None
+
+    @classmethod
+    async def http_get(cls, url, params=None):
+        """Asynchronous method to fetch a URL, with the params (if any) encoded into its query string"""
+        async with cls.get_session().get(url, params=params) as r:
+            return await r.text()
 
     @staticmethod
-    @lru_cache(maxsize=WIKI_CACHE_LIMIT)
     async def get_wikitext(item):
         """Returns the wikitext of the specified item.
 
         This method handles redirects as well.
+        Raises ValueError if there is no page for the item, and returns None if it cannot be fetched.
         """
         item = item.strip()
-        url = Controller.WIKI_API_REV_URL + item
-        response = await Controller.http_get(url)
+        wikitexts = await Controller.get_wikitexts([item])
+        if item not in wikitexts:
+            raise ValueError('Page not found')
+        return wikitexts[item]
+
+    @staticmethod
+    async def get_wikitexts(titles):
+        """Returns the wikitext of each of the specified titles, keyed by the (stripped) title.
+
+        Cached pages are returned immediately. If they were fetched more than WIKI_CACHE_TTL seconds ago,
+        they are revalidated in the background. The other pages are fetched together and cached.
+        Titles without a page are left out, and titles that cannot be fetched are mapped into None.
+        """
+        titles = list(dict.fromkeys(title.strip() for title in titles))
+        result = {}
+        uncached = []
+        for title in titles:
+            cached = Controller.wiki_cache.get(title)
+            if cached is None:
+                uncached.append(title)
+                continue
+            revid, wikitext, fetched = cached
+            Controller.revalidate_if_stale(title, revid, fetched)
+            result[title] = wikitext
+        if uncached:
+            fetched = await Controller.wiki_flight.run_batch(uncached, Controller.fetch_and_cache_wikitexts)
+            for title, (revid, wikitext) in fetched.items():
+                result[title] = wikitext
+        return result
+
+    @staticmethod
+    async def get_parsed(title, kind, parse):
+        """Returns the data of the given kind extracted from the wikitext of the title with parse(wikitext)
+
+        The data is cached together with the wikitext, so it is extracted again only when the page changes.
+        Raises ValueError if there is no page for the title, PageParseError if its wikitext cannot be parsed,
+        and returns None if it cannot be fetched.
+        """
+        title = title.strip()
+        parsed = await Controller.get_parsed_many([title], kind, parse)
+        if title not in parsed:
+            raise ValueError('Page not found')
+        if isinstance(parsed[title], PageParseError):
+            raise parsed[title]
+        return parsed[title]
+
+    @staticmethod
+    async def get_parsed_many(titles, kind, parse):
+        """Returns the data of the given kind extracted from the wikitext of each of the titles, keyed by title
+
+        The pages without cached data are fetched together.
+        Titles without a page are left out, titles that cannot be fetched are mapped into None,
+        and titles whose wikitext cannot be parsed are mapped into a PageParseError.
+        """
+        result = {}
+        uncached = []
+        for title in titles:
+            cached = Controller.wiki_cache.get_parsed(title, kind)
+            if cached is None:
+                uncached.append(title)
+                continue
+            data, revid, fetched = cached
+            Controller.revalidate_if_stale(title, revid, fetched)
+            result[title] = data
+        if uncached:
+            for title, wikitext in (await Controller.get_wikitexts(uncached)).items():
+                if wikitext is None:
+                    result[title] = None
+                    continue
+                try:
+                    result[title] = parse(wikitext)
+                except Exception as e:
+                    logging.error(f'Cannot parse the {kind} of {title}: {e!r}')
+                    result[title] = PageParseError(title)
+                    continue
+                Controller.wiki_cache.put_parsed(title, kind, result[title])
+        return result
+
+    @staticmethod
+    def revalidate_if_stale(title, revid, fetched):
+        """Revalidates the cached page of the title in the background if it was fetched more than WIKI_CACHE_TTL seconds ago"""
+        if time.time()-fetched > Controller.WIKI_CACHE_TTL and title not in Controller.revalidating:
+            Controller.revalidating.add(title)
+            run(Controller.revalidate_wikitext(title, revid))
+
+    @staticmethod
+    async def fetch_and_cache_wikitexts(titles):
+        """Returns fetch_wikitexts(titles) after storing the fetched pages in the cache"""
+        fetched = await Controller.fetch_wikitexts(titles)
+        for title, (revid, wikitext) in fetched.items():
+            if wikitext is not None:
+                Controller.wiki_cache.put(title, revid, wikitext)
+        return fetched
+
+    @staticmethod
+    async def fetch_wikitexts(titles):
+        """Returns the revision id and wikitext of the specified titles from the wiki, keyed by title.
+
+        Up to WIKI_BATCH_LIMIT titles are fetched in one request, with redirects resolved by the wiki.
+        Titles without a page are left out, and titles that cannot be fetched are mapped into (None, None).
+        """
+        result = {}
+        for start in range(0, len(titles), Controller.WIKI_BATCH_LIMIT):
+            batch = titles[start:start+Controller.WIKI_BATCH_LIMIT]
+            response = await Controller.http_get(Controller.WIKI_API_REV_URL, {'titles': '|'.join(batch)})
+            try:
+                query = json.loads(response)['query']
+                pages = {}
+                for page in query['pages'].values():
+                    if 'revisions' in page:
+                        revision = page['revisions'][0]
+                        pages[page['title']] = (revision.get('revid'), revision['slots']['main']['*'])
+                for title, target in Controller.get_query_targets(query, batch).items():
+                    if target in pages:
+                        result[title] = pages[target]
+            except Exception as e:
+                logging.info(response)
+                logging.error(e)
+                for title in batch:
+                    result[title] = (None, None)
+        return result
+
+    @staticmethod
+    def get_query_targets(query, titles):
+        """Returns the title each of the titles is normalized or redirected into in the result of a wiki query"""
+        steps = {}
+        for step in query.get('normalized', []) + query.get('redirects', []):
+            steps[step['from']] = step['to']
+        targets = {}
+        for title in titles:
+            seen = set()
+            target = title
+            while target in steps and target not in seen:
+                seen.add(target)
+                target = steps[target]
+            targets[title] = target
+        return targets
+
+    @staticmethod
+    async def get_revid(item):
+        """Returns the latest revision id of the specified item (after redirects), or None if not found"""
+        return (await Controller.get_revids([item])).get(item)
+
+    @staticmethod
+    async def get_revids(titles):
+        """Returns the latest revision id of each of the titles (after redirects), keyed by title
+
+        Up to WIKI_BATCH_LIMIT titles are checked in one request. Titles without a page are left out.
+        """
+        result = {}
+        for start in range(0, len(titles), Controller.WIKI_BATCH_LIMIT):
+            batch = titles[start:start+Controller.WIKI_BATCH_LIMIT]
+            response = await Controller.http_get(Controller.WIKI_API_INFO_URL, {'titles': '|'.join(batch)})
+            query = json.loads(response)['query']
+            revids = {page['title']: page['lastrevid'] for page in query['pages'].values() if 'lastrevid' in page}
+            for title, target in Controller.get_query_targets(query, batch).items():
+                if target in revids:
+                    result[title] = revids[target]
+        return result
+
+    @staticmethod
+    async def revalidate_wikitext(item, revid):
+        """Updates the cached wikitext of the item if the page has changed since it was fetched
+        """
         try:
-            pages = json.loads(response)['query']['pages']
-            key = list(pages.keys())[0]
-            if key == '-1':
-                raise ValueError('Page not found')
-            wikitext = pages[key]['revisions'][0]['slots']['main']['*']
-            while wikitext.startswith('#REDIRECT'):
-                item = re.findall('([^[\]]+)(?:\]|$)', wikitext[len('#REDIRECT'):].strip())[0]
-                url = Controller.WIKI_API_REV_URL + item
-                response = await Controller.http_get(url) 
-                pages = json.loads(response)['query']['pages']
-                key = list(pages.keys())[0]
-                wikitext = pages[key]['revisions'][0]['slots']['main']['*']
-            return wikitext
-        except ValueError as e:
-            raise
+            Controller.wiki_cache.revalidations += 1
+            if revid is not None and await Controller.get_revid(item) == revid:
+                Controller.wiki_cache.touch(item)
+                return
+            revid, wikitext = (await Controller.fetch_wikitexts([item])).get(item, (None, None))
+            if wikitext is not None:
+                Controller.wiki_cache.put(item, revid, wikitext)
+                Controller.wiki_cache.updates += 1
+                if item in Controller.recipe_graph:
+                    # Update the recipe graph (and the items crafted with each ingredient) with the new recipe
+                    parsed = Controller.parse_recipe(wikitext)
+                    Controller.wiki_cache.put_parsed(item, 'recipe', parsed)
+                    Controller.recipe_graph.add(item, Controller.get_recipe_ingredients(parsed))
         except Exception as e:
-            logging.info(response)
-            logging.error(e)
-            return None
+            # Keep serving the cached page
+            logging.error(f'Cannot revalidate the wiki page {item}: {e}')
+        finally:
+            Controller.revalidating.discard(item)
 
     async def execute(self, msg, command, args):
         """Entry point for any direct command
@@ -528,6 +1637,8 @@ class Controller:
                     'content': f'There is no command `{command}`',
                     'delete_after': 3,
                     })
+            except WorkerPoolFull:
+                await self.busy(msg)
             self.reply_count += 1
             self.reply_counts[command] += 1
         else:
@@ -544,19 +1655,69 @@ class Controller:
 
     @staticmethod
     async def canonical_title(title):
-        """Returns the canonical title for the given title, if found"""
-        url = Controller.WIKI_API_SEARCH_URL + title
-        response = await Controller.http_get(url)
+        """Returns the canonical title for the given title, if found
+
+        The title is resolved with the title index, then with the titles stored in the wiki cache (so that it is
+        resolved without the network before the index is loaded), and the wiki is searched only if not found there.
+        Concurrent searches of the same title (ignoring case) share one request.
+        """
+        title = title.strip()
+        result = Controller.title_index.resolve(title)
+        if result is not None:
+            if result != title and Controller.wiki_cache.get_title(title) != result:
+                Controller.wiki_cache.put_title(title, result)
+            return result
+        found, result = Controller.title_index.get_search(title, Controller.TITLE_NEGATIVE_TTL)
+        if found:
+            return result
+        result = Controller.wiki_cache.get_title(title)
+        if result is not None:
+            return result
         try:
-            pages = json.loads(response)['query']['search']
-            if len(pages) == 0:
-                return None
-            for page in pages:
-                if page['title'].lower() == title.lower():
-                    return page['title']
-            return pages[0]['title']
-        except:
+            result = await Controller.search_flight.run(title.lower(), Controller.search_title, title)
+        except Exception as e:
+            logging.error(f'Cannot search the wiki for {title}: {e}')
+            return None
+        Controller.title_index.put_search(title, result)
+        if result is not None:
+            Controller.wiki_cache.put_title(title, result)
+        return result
+
+    @staticmethod
+    async def search_title(title):
+        """Returns the title of the best search result for the given title, or None if nothing is found"""
+        response = await Controller.http_get(Controller.WIKI_API_SEARCH_URL, {'srsearch': title})
+        pages = json.loads(response)['query']['search']
+        if len(pages) == 0:
             return None
+        for page in pages:
+            if page['title'].lower() == title.lower():
+                return page['title']
+        return pages[0]['title']
+
+    @staticmethod
+    async def query_all(url, params=None):
+        """Yields the query results of all the continuations of the wiki API URL with the params"""
+        params = params or {}
+        continuation = {}
+        while True:
+            response = json.loads(await Controller.http_get(url, {**params, **continuation}))
+            yield response.get('query', {})
+            if 'continue' not in response:
+                return
+            continuation = response['continue']
+
+    @staticmethod
+    async def update_title_index():
+        """Replaces the title index with the titles of all pages and redirects on the wiki"""
+        titles = []
+        async for query in Controller.query_all(Controller.WIKI_API_ALLPAGES_URL):
+            titles.extend(page['title'] for page in query.get('allpages', []))
+        redirects = []
+        async for query in Controller.query_all(Controller.WIKI_API_REDIRECTS_URL):
+            redirects.extend((redirect['from'], redirect['to']) for redirect in query.get('redirects', []))
+        Controller.title_index.update(titles, redirects)
+        logging.info(f'Updated the title index with {len(titles)} titles and {len(redirects)} redirects')
 
     @staticmethod
     def link_from_title(title):
@@ -607,6 +1768,9 @@ class Controller:
             return
         if not item:
             return
+        if item == 'tree':
+            await self.recipe_tree(msg, *args)
+            return
         if args:
             item = f'{item} {" ".join(args)}'
         canonical = await Controller.canonical_title(item)
@@ -633,7 +1797,10 @@ class Controller:
                 })
             return
         try:
-            wikitext = await Controller.get_wikitext(item)
+            parsed = await Controller.get_parsed(item, 'recipe', Controller.parse_recipe)
+        except PageParseError:
+            await self.wiki_unparsable(msg, item)
+            return
         except ValueError as e:
             # Means the page is not found
             await msg.channel.send(**{
@@ -643,83 +1810,247 @@ class Controller:
                 'delete_after': 3,
                 })
             return
+        if parsed is None:
+            await self.wiki_unavailable(msg, item)
+            return
         try:
             emojis = {emoji.name.lower(): f'<:{emoji.name}:{emoji.id}> ' for emoji in msg.guild.emojis if emoji.available}
             for k, v in list(emojis.items()):
                 emojis[k+'s'] = v
         except:
             emojis = {}
-        parsed = WTP.parse(wikitext)
-        content = None
-        template_names = []
-        version = '??'
-        for template in parsed.templates:
-            template_names.append(template.name.strip())
-            if template.name.strip().lower() == 'version':
-                version = template.arguments[0].string.strip(' |')
-            if template.name.strip().lower() == 'recipe':
-                args = template.arguments
-                logging.info(args)
-                ingredients = []
-                tools = []
-                level = []
-                points = []
-                def parse_args(args):
-                    idx = 0
-                    while idx < len(args):
-                        arg = args[idx].string.strip(' |')
-                        if arg == '':
-                            idx += 1
-                            continue
-                        if '=' not in arg:
-                            amount = args[idx+1].string.strip(' |')
-                            if not amount or amount != '0':
-                                ingredients.append(f'{emojis.get(arg.lower().replace(" ", "_"), "")}{arg.capitalize()} x{amount}')
-                            else:
-                                ingredients.append(f'{emojis.get(arg.lower().replace(" ", "_"), "")}{arg.capitalize()}')
-                            idx += 1
-                        elif arg.startswith('Tool'):
-                            tools.append(arg.split('=', maxsplit=1)[1].strip().capitalize())
-                        elif arg.startswith('input'):
-                            templates = WTP.parse(arg.split('=', maxsplit=1)[1].strip()).templates
-                            if len(templates) > 0:
-                                parse_args(templates[0].arguments)
-                            else:
-                                # Not a template
-                                for ingredient in arg.split('=', maxsplit=1)[1].strip().split('*')[1:]:
-                                    name, quantity = ingredient.rsplit('x', maxsplit=1)
-                                    name = name.replace('[','').replace(']','').strip()
-                                    quantity = quantity.strip()
-                                    ingredients.append(f'{emojis.get(name.lower().replace(" ", "_"), "")}{name} x{quantity}')
-                        elif arg.startswith('level'):
-                            try:
-                                level.append(int(arg.split('=')[1].strip()))
-                            except:
-                                pass
-                        elif arg.startswith('research'):
-                            try:
-                                points.append(int(arg.split('=')[1].strip()))
-                            except:
-                                pass
-                        idx += 1
-                parse_args(args)
-                requirements = ''
-                if level:
-                    if points:
-                        requirements = f' (level {level[0]}, {points[0]} points)'
-                    else:
-                        requirements = f' (level {level[0]})'
-                ingredients = '• '+'\n• '.join(ingredients)
-                tools = '• '+'\n• '.join(tools) if tools else ''
-                content = f'To craft {item}{requirements}, you need:\n{ingredients}'
-                if tools:
-                    content = f'{content}\nAnd these tools:\n{tools}'
+        recipe = parsed['recipe']
+        if recipe is None:
+            await msg.channel.send(**{
+                'content': f'No recipe found for `{item}`',
+                'reference': msg.to_reference(),
+                'mention_author': True,
+                'delete_after': 3,
+                })
+            return
+        ingredients = [Controller.format_ingredient(ingredient, emojis) for ingredient in recipe['ingredients']]
+        ingredients = '• '+'\n• '.join(ingredients)
+        if recipe['kind'] == 'recipe':
+            requirements = ''
+            if recipe['level']:
+                if recipe['points']:
+                    requirements = f' (level {recipe["level"][0]}, {recipe["points"][0]} points)'
+                else:
+                    requirements = f' (level {recipe["level"][0]})'
+            tools = '• '+'\n• '.join(recipe['tools']) if recipe['tools'] else ''
+            content = f'To craft {item}{requirements}, you need:\n{ingredients}'
+            if tools:
+                content = f'{content}\nAnd these tools:\n{tools}'
+        elif recipe['kind'] == 'recipespecialist':
+            if recipe['level']:
+                requirements = f' (at {recipe["town"][0]} at workshop level {recipe["level"][0]})'
+            else:
+                requirements = f' (at {recipe["town"][0]})'
+            content = f'To craft {item}{requirements}, you need:\n{ingredients}'
+        else:
+            content = f'To cook {item}, you need:\n{ingredients}'
+        content += f'\nSource: {page_url} (version {parsed["version"]})'
+        await msg.channel.send(**{
+            'content': content,
+            'reference': msg.to_reference(),
+            'mention_author': True,
+            })
+
+    async def recipe_tree(self, msg, *args):
+        """Replies the user with the crafting tree of the given quantity of the item, and the total raw materials
+        """
+        if not args:
+            await self.help(msg, 'recipe', intro='Please provide an item name')
+            return
+        quantity = 1
+        if len(args) > 1 and args[-1].replace(',', '').isdigit():
+            quantity = int(args[-1].replace(',', ''))
+            args = args[:-1]
+        item = ' '.join(args)
+        canonical = await Controller.canonical_title(item)
+        if canonical:
+            item = canonical
+        await Controller.load_recipe_graph(item)
+        if item not in Controller.recipe_graph:
+            await self.wiki_unavailable(msg, item)
+            return
+        if not Controller.recipe_graph.get(item):
+            await msg.channel.send(**{
+                'content': f'No crafting recipe found for `{item}`',
+                'reference': msg.to_reference(),
+                'mention_author': True,
+                'delete_after': 3,
+                })
+            return
+        try:
+            emojis = {emoji.name.lower(): f'<:{emoji.name}:{emoji.id}> ' for emoji in msg.guild.emojis if emoji.available}
+            for k, v in list(emojis.items()):
+                emojis[k+'s'] = v
+        except:
+            emojis = {}
+        tree, totals = Controller.recipe_graph.expand(item, quantity, Controller.RECIPE_TREE_DEPTH)
+        tree = '\n'.join('\t'*depth + f'• {Controller.format_ingredient((key, name, f"{amount:,}"), emojis)}'
+                         for depth, key, name, amount in tree)
+        totals = '\n'.join(f'• {Controller.format_ingredient((key, name, f"{amount:,}"), emojis)}'
+                           for key, name, amount in totals.values())
+        source = f'Source: {Controller.link_from_title(item)}'
+        content = f'To craft {item} x{quantity:,}, you need:\n{tree}\nWhich is in total:\n{totals}\n{source}'
+        if len(content) > 2000:
+            # Too long for one message, so only show the total
+            content = f'To craft {item} x{quantity:,}, you need in total:\n{totals}\n{source}'
+        if len(content) > 2000:
+            content = f'{content[:1990-len(source)]}…\n{source}'
+        await msg.channel.send(**{
+            'content': content,
+            'reference': msg.to_reference(),
+            'mention_author': True,
+            })
+
+    @staticmethod
+    async def load_recipe_graph(title):
+        """Adds the crafting recipes of the item and its ingredients (recursively) into the recipe graph
+
+        The pages are fetched level by level, with the pages of each level fetched together.
+        """
+        graph = Controller.recipe_graph
+        seen = {title}
+        level = [title]
+        for _ in range(Controller.RECIPE_TREE_DEPTH+1):
+            missing = [title for title in level if title not in graph]
+            if missing:
+                parsed = await Controller.get_parsed_many(missing, 'recipe', Controller.parse_recipe)
+                Controller.add_recipes(missing, parsed)
+            next_level = []
+            for child in graph.get_children(level):
+                if child not in seen and len(seen) < Controller.RECIPE_TREE_LIMIT:
+                    seen.add(child)
+                    next_level.append(child)
+            level = next_level
+            if not level:
                 break
-            elif template.name.strip().lower() == 'recipespecialist':
-                args = template.arguments
-                logging.info(args)
+
+    @staticmethod
+    async def update_recipe_index():
+        """Adds the crafting recipes of all pages using the recipe templates into the recipe graph
+
+        The pages are fetched in batches. The recipes already in the graph are only fetched and parsed again
+        if their pages have changed since they were cached.
+        """
+        graph = Controller.recipe_graph
+        titles = []
+        for template in Controller.RECIPE_TEMPLATES:
+            async for query in Controller.query_all(Controller.WIKI_API_EMBEDDEDIN_URL, {'eititle': template}):
+                titles.extend(page['title'] for page in query.get('embeddedin', []))
+        titles = list(dict.fromkeys(titles))
+        # The recipes in the graph include those whose pages may no longer use the templates
+        known = [title for title in dict.fromkeys(titles + [title for title in graph.edges if graph.get(title)])
+                 if title in graph]
+        changed = await Controller.get_changed_titles(known)
+        if changed:
+            fetched = await Controller.fetch_and_cache_wikitexts(changed)
+            for title in changed:
+                if title not in fetched:
+                    # The page has been deleted
+                    graph.add(title, None)
+            # The pages that cannot be fetched now are checked again in the next update
+            changed = [title for title in changed if fetched.get(title, (None, None))[1] is not None]
+        missing = [title for title in titles if title not in graph] + changed
+        for start in range(0, len(missing), Controller.WIKI_BATCH_LIMIT):
+            batch = missing[start:start+Controller.WIKI_BATCH_LIMIT]
+            parsed = await Controller.get_parsed_many(batch, 'recipe', Controller.parse_recipe)
+            Controller.add_recipes(batch, parsed)
+            # Let other tasks run between the batches
+            await sleep(0)
+        Controller.recipe_index_updated = datetime.now()
+        logging.info(f'Updated the recipe index with {len(missing)-len(changed)} new and {len(changed)} changed pages: '
+                     f'{graph.get_status()}')
+
+    @staticmethod
+    async def rebuild_recipe_index():
+        """Clears the recipe index and builds it again, once the update in flight (if any) is done"""
+        while 'recipe_index' in Controller.recipe_index_flight.tasks:
+            await wait([Controller.recipe_index_flight.tasks['recipe_index']])
+        Controller.recipe_graph.clear()
+        Controller.recipe_index_updated = None
+        try:
+            await Controller.recipe_index_flight.run('recipe_index', Controller.update_recipe_index)
+        except Exception as e:
+            logging.error(f'Cannot rebuild the recipe index: {e}')
+
+    @staticmethod
+    async def get_changed_titles(titles):
+        """Returns the titles whose latest revision differs from the cached one, including those not cached"""
+        revids = await Controller.get_revids(titles)
+        changed = []
+        for title in titles:
+            cached = Controller.wiki_cache.get(title)
+            if cached is None or revids.get(title) != cached[0]:
+                changed.append(title)
+        return changed
+
+    @staticmethod
+    def add_recipes(titles, parsed):
+        """Adds the recipes of the titles from the result of get_parsed_many into the recipe graph
+
+        Titles that could not be fetched are not added, so that they are tried again later.
+        Titles that could not be parsed are added without a recipe.
+        """
+        for title in titles:
+            if title in parsed and parsed[title] is None:
+                continue
+            if isinstance(parsed.get(title), PageParseError):
+                Controller.recipe_graph.add(title, None)
+                continue
+            Controller.recipe_graph.add(title, Controller.get_recipe_ingredients(parsed.get(title)))
+
+    @staticmethod
+    def get_recipe_ingredients(parsed):
+        """Returns the list of (title, emoji key, name, amount) of the ingredients in the crafting recipe extracted
+        by parse_recipe, or None if there is no crafting recipe
+        """
+        if parsed is None or parsed['recipe'] is None or parsed['recipe']['kind'] == 'cooking':
+            return None
+        ingredients = []
+        for key, name, amount in parsed['recipe']['ingredients']:
+            title = key.replace('_', ' ')
+            title = Controller.title_index.resolve(title) or f'{title[:1].upper()}{title[1:]}'
+            ingredients.append((title, key, name, amount))
+        return ingredients
+
+    @staticmethod
+    def format_ingredient(ingredient, emojis):
+        """Returns the text of an ingredient extracted by parse_recipe, with the emoji of the item if available"""
+        key, name, amount = ingredient
+        if amount is None:
+            return f'{emojis.get(key, "")}{name}'
+        return f'{emojis.get(key, "")}{name} x{amount}'
+
+    @staticmethod
+    def parse_recipe(wikitext):
+        """Extracts the recipe from the wikitext of an item
+
+        Returns a dictionary with the version of the page and the recipe (None if there is no recipe).
+        The recipe is a dictionary with the following keys:
+        - kind: Either 'recipe' (crafting), 'recipespecialist' (crafting at a workshop), or 'cooking'
+        - ingredients: The list of [emoji key, name, amount] of the ingredients, where amount may be None
+        - tools: The list of tools needed
+        - level, points, town: The lists of the level, research points, and town required
+        Cooking recipes in tables take precedence over crafting recipes in templates.
+        """
+        parsed = WTP.parse(wikitext)
+        recipe = None
+        template_names = []
+        version = '??'
+        for template in parsed.templates:
+            template_names.append(template.name.strip())
+            if template.name.strip().lower() == 'version':
+                version = template.arguments[0].string.strip(' |')
+            kind = template.name.strip().lower()
+            if kind in ['recipe', 'recipespecialist']:
                 ingredients = []
+                tools = []
                 level = []
+                points = []
                 town = []
                 def parse_args(args):
                     idx = 0
@@ -729,58 +2060,61 @@ class Controller:
                             idx += 1
                             continue
                         if '=' not in arg:
-                            amount = args[idx+1].string.strip(' |')
+                            if idx+1 < len(args):
+                                amount = args[idx+1].string.strip(' |')
+                            else:
+                                # The amount of the last ingredient is missing
+                                amount = None
+                            key = arg.lower().replace(' ', '_')
                             if not amount or amount != '0':
-                                ingredients.append(f'{emojis.get(arg.lower().replace(" ", "_"), "")}{arg.capitalize()} x{amount}')
+                                ingredients.append([key, arg.capitalize(), amount])
                             else:
-                                ingredients.append(f'{emojis.get(arg.lower().replace(" ", "_"), "")}{arg.capitalize()}')
+                                ingredients.append([key, arg.capitalize(), None])
                             idx += 1
+                        elif arg.startswith('Tool') and kind == 'recipe':
+                            tools.append(arg.split('=', maxsplit=1)[1].strip().capitalize())
                         elif arg.startswith('input'):
                             templates = WTP.parse(arg.split('=', maxsplit=1)[1].strip()).templates
                             if len(templates) > 0:
                                 parse_args(templates[0].arguments)
+                            elif kind == 'recipe':
+                                # Not a template
+                                for ingredient in arg.split('=', maxsplit=1)[1].strip().split('*')[1:]:
+                                    if 'x' not in ingredient:
+                                        # No amount
+                                        continue
+                                    name, quantity = ingredient.rsplit('x', maxsplit=1)
+                                    name = name.replace('[','').replace(']','').strip()
+                                    quantity = quantity.strip()
+                                    ingredients.append([name.lower().replace(' ', '_'), name, quantity])
                         elif arg.startswith('level'):
                             try:
                                 level.append(int(arg.split('=')[1].strip()))
                             except:
                                 pass
-                        elif arg.startswith('town'):
+                        elif arg.startswith('research') and kind == 'recipe':
+                            try:
+                                points.append(int(arg.split('=')[1].strip()))
+                            except:
+                                pass
+                        elif arg.startswith('town') and kind == 'recipespecialist':
                             town.append(arg.split('=')[1].strip())
                         idx += 1
-                parse_args(args)
-                requirements = ''
-                if level:
-                    requirements = f' (at {town[0]} at workshop level {level[0]})'
-                else:
-                    requirements = f' (at {town[0]})'
-                ingredients = '• '+'\n• '.join(ingredients)
-                content = f'To craft {item}{requirements}, you need:\n{ingredients}'
+                parse_args(template.arguments)
+                recipe = {'kind': kind, 'ingredients': ingredients, 'tools': tools, 'level': level, 'points': points, 'town': town}
                 break
-        logging.info(f'Templates in {item}: {", ".join(template_names)}')
+        logging.info(f'Templates: {", ".join(template_names)}')
         for table in parsed.tables:
             if 'Ingredients' in table:
                 rows = table.string.split('|-')[1:]
                 ingredients = [row.strip(' \t\n|').split('\n')[0].strip(' \t\n|').replace('[[', '').replace(']]', '').split('|')[-1] for row in rows]
-                ingredients = [f'{emojis.get(" ".join(ingredient.split(" ")[:-1]).lower().replace(" ", "_"), "")}{ingredient}' for ingredient in ingredients]
-                ingredients = '• '+'\n• '.join(ingredients)
-                content = f'To cook {item}, you need:\n{ingredients}'
+                ingredients = [[' '.join(ingredient.split(' ')[:-1]).lower().replace(' ', '_'), ingredient, None] for ingredient in ingredients]
+                recipe = {'kind': 'cooking', 'ingredients': ingredients, 'tools': [], 'level': [], 'points': [], 'town': []}
                 break
-        if content is None:
-            await msg.channel.send(**{
-                'content': f'No recipe found for `{item}`',
-                'reference': msg.to_reference(),
-                'mention_author': True,
-                'delete_after': 3,
-                })
-            return
-        content += f'\nSource: {page_url} (version {version})'
-        await msg.channel.send(**{
-            'content': content,
-            'reference': msg.to_reference(),
-            'mention_author': True,
-            })
+        return {'version': version, 'recipe': recipe}
 
-    def is_infobox(self, name):
+    @staticmethod
+    def is_infobox(name):
         """Returns True if the template name is a type of infobox
         """
         name = name.strip()
@@ -794,6 +2128,39 @@ class Controller:
             return True
         return False
 
+    @staticmethod
+    def parse_infoboxes(wikitext):
+        """Extracts the infoboxes from the wikitext of an item
+
+        Returns the list of [template name, title (None if not specified), version of the page, entries]
+        of each infobox, where the entries are a dictionary from the name into the value of each field.
+        """
+        infoboxes = []
+        template_names = []
+        version = '??'
+        for template in WTP.parse(wikitext).templates:
+            template_names.append(template.name.strip())
+            if template.name.strip().lower() == 'version':
+                version = template.arguments[0].string.strip(' |')
+            if Controller.is_infobox(template.name):
+                title = None
+                entries = {}
+                for arg in template.arguments:
+                    k, v = arg.string.strip(' |\n').split('=')
+                    k = k.strip()
+                    v = v.strip()
+                    if k.lower() in ['title1', 'name']:
+                        # Set this as the item name
+                        title = v
+                    elif k.lower() in ['image1', 'image'] or not v:
+                        # Skip images and empty values
+                        continue
+                    else:
+                        entries[k] = v.replace('\n\n', '\n').replace('\n', '\n\t')
+                infoboxes.append([template.name.strip(), title, version, entries])
+        logging.info(f'Templates: '+', '.join(template_names))
+        return infoboxes
+
     async def info(self, msg, item=None, *args):
         """Replies the user with the information from infobox of the specified item
         """
@@ -814,7 +2181,10 @@ class Controller:
             item = canonical
         page_url = Controller.link_from_title(item)
         try:
-            wikitext = await Controller.get_wikitext(item)
+            infoboxes = await Controller.get_parsed(item, 'infobox', Controller.parse_infoboxes)
+        except PageParseError:
+            await self.wiki_unparsable(msg, item)
+            return
         except ValueError as e:
             # Means the page is not found
             await msg.channel.send(**{
@@ -824,34 +2194,15 @@ class Controller:
                 'delete_after': 3,
                 })
             return
+        if infoboxes is None:
+            await self.wiki_unavailable(msg, item)
+            return
         contents = []
-        template_names = []
-        version = '??'
-        for template in WTP.parse(wikitext).templates:
-            template_names.append(template.name.strip())
-            if template.name.strip().lower() == 'version':
-                version = template.arguments[0].string.strip(' |')
-            if self.is_infobox(template.name):
-                args = template.arguments
-                title = item
-                entries = {}
-                for arg in args:
-                    k, v = arg.string.strip(' |\n').split('=')
-                    k = k.strip()
-                    v = v.strip()
-                    if k.lower() in ['title1', 'name']:
-                        # Set this as the item name
-                        title = v
-                    elif k.lower() in ['image1', 'image'] or not v:
-                        # Skip images and empty values
-                        continue
-                    else:
-                        entries[k] = v.replace('\n\n', '\n').replace('\n', '\n\t')
-                entries = [f'{k} = {v}' for k, v in entries.items()]
-                entries = '• '+'\n• '.join(entries)
-                content = f'## **{title}** ##\nSource: {page_url} (version {version})\n{template.name.strip()}\n{entries}'
-                contents.append(content)
-        logging.info(f'Templates at {item}: '+', '.join(template_names))
+        for name, title, version, entries in infoboxes:
+            entries = [f'{k} = {v}' for k, v in entries.items()]
+            entries = '• '+'\n• '.join(entries)
+            content = f'## **{title or item}** ##\nSource: {page_url} (version {version})\n{name}\n{entries}'
+            contents.append(content)
         if not contents:
             await msg.channel.send(**{
                 'content': f'No infobox found for `{item}`',
@@ -867,97 +2218,174 @@ class Controller:
             })
 
     async def get_trading_table(self):
-        """Fetch and cache the trading table from wiki
+        """Returns the trading table from wiki
+
+        The table is loaded when first needed if the table refresher has not loaded it yet.
         """
         if self.trading_table is None:
-            self.trading_table = {}
-            wikitext = await Controller.get_wikitext('Trading')
-            wikilines = wikitext.split('\n')
-            start_line = 0
-            for idx, line in enumerate(wikilines):
-                if 'Trading in Survivor Camps' in line:
-                    start_line = idx
-                    break
-            wikitext = '\n'.join(wikilines[idx+1:])
-            for row in wikitext.split('|-')[1:-1]:
-                if row.strip().startswith('<!--'):
-                    continue
-                try:
-                    icon, base_name, item, price, currency, stock, min_level = row.split('||')
-                    base_name = base_name.lower()
-                    if base_name not in self.trading_table:
-                        self.trading_table[base_name] = {}
-                    trade_list = self.trading_table[base_name]
-                    item_name = item.split(']]', 1)[1].strip(' []')
-                    if item_name in ['Coal', 'Brick']:
-                        units = 10
-                    elif item_name in ['Gunpowder', 'Sulfur', 'Saltpeter', 'Scrap', 'Lead', 'Machine oil']:
-                        units = 100
-                    elif item_name in ['Gasoline', 'Diesel']:
-                        units = 1000
-                    else:
-                        units = 1
-                    currency = currency.split(']]')[-1].strip()
-                    trade_list[item_name.lower()] = (item_name, int(price), currency, int(stock), units, int(min_level))
-                except:
-                    print(row)
-                    raise
+            await Controller.table_flight.run('tables', self.refresh_tables, False)
+        if self.trading_table is None:
+            return {}
         return self.trading_table
 
+    @staticmethod
+    def parse_trading_table(wikitext):
+        """Returns the trading table in the wikitext of the Trading page, and its ItemIndex
+        """
+        trading_table = {}
+        wikilines = wikitext.split('\n')
+        start_line = 0
+        for idx, line in enumerate(wikilines):
+            if 'Trading in Survivor Camps' in line:
+                start_line = idx
+                break
+        wikitext = '\n'.join(wikilines[idx+1:])
+        for row in wikitext.split('|-')[1:-1]:
+            if row.strip().startswith('<!--'):
+                continue
+            try:
+                icon, base_name, item, price, currency, stock, min_level = row.split('||')
+                base_name = base_name.lower()
+                if base_name not in trading_table:
+                    trading_table[base_name] = {}
+                trade_list = trading_table[base_name]
+                item_name = item.split(']]', 1)[1].strip(' []')
+                if item_name in ['Coal', 'Brick']:
+                    units = 10
+                elif item_name in ['Gunpowder', 'Sulfur', 'Saltpeter', 'Scrap', 'Lead', 'Machine oil']:
+                    units = 100
+                elif item_name in ['Gasoline', 'Diesel']:
+                    units = 1000
+                else:
+                    units = 1
+                currency = currency.split(']]')[-1].strip()
+                trade_list[item_name.lower()] = (item_name, int(price), currency, int(stock), units, int(min_level))
+            except:
+                print(row)
+                raise
+        trading_index = ItemIndex()
+        for base_name, trade_list in trading_table.items():
+            for item_name, trade in trade_list.items():
+                trading_index.add(item_name, (base_name, trade))
+        return trading_table, trading_index
+
     async def get_buyer_table(self):
-        """Fetch and cache the buyer table from wiki
+        """Returns the buyer table from wiki
+
+        The table is loaded when first needed if the table refresher has not loaded it yet.
         """
         if self.buyer_table is None:
-            self.buyer_table = {}
-            wikitext = await Controller.get_wikitext('Buyer')
-            wikilines = wikitext.split('\n')
-            start_line = 0
-            for idx, line in enumerate(wikilines):
-                if 'Item Sell Price' in line:
-                    start_line = idx
-                    break
-            wikitext = '\n'.join(wikilines[idx+1:])
-            for row in wikitext.split('|-')[2:]:
-                try:
-                    icon, item, br_cost, in_cost, rc_cost, ratio = row.split('||')
-                    if item.split(']]')[-1].strip():
-                        units = int(item.split(']]')[-1].strip()[1:])
-                        item = item.rsplit(']]',1)[0].strip()
-                    else:
-                        units = 1
-                    item_name = item.replace('[','').replace(']','').strip().split('|')[-1]
-                    ratio = ratio.split('\n')[0].strip()
-                    self.buyer_table[item_name.lower()] = (item_name, units, int(br_cost), int(in_cost), int(rc_cost), ratio)
-                except:
-                    print(row)
-                    raise
+            await Controller.table_flight.run('tables', self.refresh_tables, False)
+        if self.buyer_table is None:
+            return {}
         return self.buyer_table
 
+    @staticmethod
+    def parse_buyer_table(wikitext):
+        """Returns the buyer table in the wikitext of the Buyer page, and its ItemIndex
+        """
+        buyer_table = {}
+        wikilines = wikitext.split('\n')
+        start_line = 0
+        for idx, line in enumerate(wikilines):
+            if 'Item Sell Price' in line:
+                start_line = idx
+                break
+        wikitext = '\n'.join(wikilines[idx+1:])
+        for row in wikitext.split('|-')[2:]:
+            try:
+                icon, item, br_cost, in_cost, rc_cost, ratio = row.split('||')
+                if item.split(']]')[-1].strip():
+                    units = int(item.split(']]')[-1].strip()[1:])
+                    item = item.rsplit(']]',1)[0].strip()
+                else:
+                    units = 1
+                item_name = item.replace('[','').replace(']','').strip().split('|')[-1]
+                ratio = ratio.split('\n')[0].strip()
+                buyer_table[item_name.lower()] = (item_name, units, int(br_cost), int(in_cost), int(rc_cost), ratio)
+            except:
+                print(row)
+                raise
+        buyer_index = ItemIndex()
+        for item_name, price in buyer_table.items():
+            buyer_index.add(item_name, price)
+        return buyer_table, buyer_index
+
     async def get_workshop_table(self):
-        """Fetch and cache the workshop (specialist) table from wiki
+        """Returns the workshop (specialist) table from wiki
+
+        The table is loaded when first needed if the table refresher has not loaded it yet.
         """
         if self.workshop_table is None:
-            self.workshop_table = {}
-            wikitext = await Controller.get_wikitext('Specialist')
-            bases = re.split(r'(?:\|rowspan=[57]\||style="text-align:left" \|)', wikitext)[1:]
-            idx = 0
+            await Controller.table_flight.run('tables', self.refresh_tables, False)
+        if self.workshop_table is None:
+            return {}
+        return self.workshop_table
+
+    @staticmethod
+    def parse_workshop_table(wikitext):
+        """Returns the workshop table in the wikitext of the Specialist page, and its ItemIndex
+        """
+        workshop_table = {}
+        bases = re.split(r'(?:\|rowspan=[57]\||style="text-align:left" \|)', wikitext)[1:]
+        idx = 0
+        while idx < len(bases):
+            base_name = bases[idx].split('<br>', 1)[1].split('||')[0]
+            craftable = []
+            workshop_table[base_name.lower()] = (base_name, craftable)
+            idx += 1
+            level = 1
             while idx < len(bases):
-                base_name = bases[idx].split('<br>', 1)[1].split('||')[0]
-                craftable = []
-                self.workshop_table[base_name.lower()] = (base_name, craftable)
+                if bases[idx][bases[idx].find(']]')+2] == ' ':
+                    # Craftable list
+                    for item in bases[idx].split('|-', 1)[0].split('<br>'):
+                        craftable.append((item.split(']] ')[1].strip('[]\n'), level))
+                else:
+                    # Base name
+                    break
                 idx += 1
-                level = 1
-                while idx < len(bases):
-                    if bases[idx][bases[idx].find(']]')+2] == ' ':
-                        # Craftable list
-                        for item in bases[idx].split('|-', 1)[0].split('<br>'):
-                            craftable.append((item.split(']] ')[1].strip('[]\n'), level))
-                    else:
-                        # Base name
-                        break
-                    idx += 1
-                    level += 1
-        return self.workshop_table
+                level += 1
+        workshop_index = ItemIndex()
+        for base_name, craftables in workshop_table.values():
+            for item_name, level in craftables:
+                workshop_index.add(item_name, (base_name, level))
+        return workshop_table, workshop_index
+
+    async def refresh_tables(self, fetch=True):
+        """Rebuilds the trading, buyer, and workshop tables from the wiki
+
+        If fetch is False, the cached pages are used if available.
+        Each table (with its index) is replaced at once, and is kept if the page cannot be fetched or parsed.
+        The update time only advances if at least one table is refreshed.
+        """
+        tables = [('trading', 'Trading', Controller.parse_trading_table),
+                  ('buyer', 'Buyer', Controller.parse_buyer_table),
+                  ('workshop', 'Specialist', Controller.parse_workshop_table)]
+        try:
+            if fetch:
+                fetched = await Controller.fetch_and_cache_wikitexts(Controller.TABLE_PAGES)
+                wikitexts = {title: wikitext for title, (revid, wikitext) in fetched.items()}
+            else:
+                wikitexts = await Controller.get_wikitexts(Controller.TABLE_PAGES)
+        except Exception as e:
+            logging.error(f'Cannot fetch the tables: {e}')
+            self.table_errors = [name for name, _, _ in tables]
+            return
+        errors = []
+        for name, title, parse in tables:
+            try:
+                table, index = parse(wikitexts[title])
+                if not table:
+                    raise ValueError('No rows found')
+            except Exception as e:
+                logging.error(f'Cannot build the {name} table from {title} page: {e}')
+                errors.append(name)
+                continue
+            setattr(self, f'{name}_table', table)
+            setattr(self, f'{name}_index', index)
+        self.table_errors = errors
+        if len(errors) < len(tables):
+            self.tables_updated = datetime.now()
 
     async def trader(self, msg, arg=None, *args):
         """Replies the user with a list of places that trade for and from the item
@@ -989,14 +2417,8 @@ class Controller:
                 # An item name or not found
                 item = arg
                 trade_list = []
-                for base_name, items in trading_table.items():
-                    aliases = [item.lower(), item+'s'.lower(), item[:-1].lower() if item[-1] == 's' else '', item+' metal', 'sulfuric '+item]
-                    for alias in aliases:
-                        if not alias:
-                            continue
-                        if alias in items:
-                            item_name, price, currency, stock, units, min_level = items[alias]
-                            trade_list.append(f'• At **{base_name.capitalize()}**: {units} {item_name} for {price} {currency} (max {stock}), level {min_level}')
+                for base_name, (item_name, price, currency, stock, units, min_level) in self.trading_index.lookup(item):
+                    trade_list.append(f'• At **{base_name.capitalize()}**: {units} {item_name} for {price} {currency} (max {stock}), level {min_level}')
                 if len(trade_list) == 0:
                     content = f'Could not find any trading option for `{item}`'
                     self_delete = True
@@ -1038,19 +2460,14 @@ class Controller:
 
         buyer_list = []
         for item in items:
-            aliases = [item.lower(), item+'s'.lower(), item[:-1].lower() if item[-1] == 's' else '', item+' metal', 'sulfuric '+item]
             found = False
-            for alias in aliases:
-                if not alias:
-                    continue
-                if alias in buyer_table:
-                    item_name, units, br_cost, in_cost, rc_cost, ratio = buyer_table[alias]
-                    if ratio == '-':
-                        ratio_msg = f'(the trader does not sell this item)'
-                    else:
-                        ratio_msg = f'(approximately {ratio} of Trader price)'
-                    buyer_list.append(f'• You can sell __{units} {item_name}__ for **{br_cost} Black rubles** or **{in_cost} Iron nuts** or **{rc_cost} Ration cards** {ratio_msg}')
-                    found = True
+            for item_name, units, br_cost, in_cost, rc_cost, ratio in self.buyer_index.lookup(item):
+                if ratio == '-':
+                    ratio_msg = f'(the trader does not sell this item)'
+                else:
+                    ratio_msg = f'(approximately {ratio} of Trader price)'
+                buyer_list.append(f'• You can sell __{units} {item_name}__ for **{br_cost} Black rubles** or **{in_cost} Iron nuts** or **{rc_cost} Ration cards** {ratio_msg}')
+                found = True
             if not found:
                 buyer_list.append(f'• The Buyer does not accept the item "{item}"')
         content = '\n'.join(buyer_list)
@@ -1061,6 +2478,49 @@ class Controller:
                 }
         await msg.channel.send(**response)
 
+    async def uses(self, msg, item=None, *args):
+        """Replies the user with the items crafted with the specified item
+        """
+        if not item:
+            await self.help(msg, 'uses', intro='Please provide an item name')
+            return
+        if args:
+            item = f'{item} {" ".join(args)}'
+        query = item
+        canonical = await Controller.canonical_title(item)
+        if canonical:
+            item = canonical
+        if Controller.recipe_index_updated is None:
+            await msg.channel.send(**{
+                'content': 'The list of recipes is still being built, please try again later',
+                'reference': msg.to_reference(),
+                'mention_author': True,
+                'delete_after': 3,
+                })
+            return
+        # Ingredients not found in the title index are stored under their names, which may be in another form
+        names = [item, query] + get_singular_plural_forms(normalize_title(item)) + get_singular_plural_forms(normalize_title(query))
+        products = {}
+        for name in dict.fromkeys(names):
+            products.update(Controller.recipe_graph.get_uses(name))
+        if not products:
+            await msg.channel.send(**{
+                'content': f'No recipe uses `{item}`',
+                'reference': msg.to_reference(),
+                'mention_author': True,
+                'delete_after': 3,
+                })
+            return
+        uses_list = [f'• {product} (needs x{amount})' if amount else f'• {product}' for product, amount in sorted(products.items())]
+        content = f'{item} is used to craft:\n' + '\n'.join(uses_list)
+        if len(content) > 2000:
+            content = f'{content[:1999]}…'
+        await msg.channel.send(**{
+            'content': content,
+            'reference': msg.to_reference(),
+            'mention_author': True,
+            })
+
     async def workshop(self, msg, arg=None, *args):
         """Replies the user with a list of places that sells the specified item
         if the argument is an item name, and a list of possible trades if the argument is a location name
@@ -1089,14 +2549,8 @@ class Controller:
                 # An item name or not found
                 item = arg
                 craft_list = []
-                for base_name, craftables in workshop_table.values():
-                    aliases = [item.lower(), item+'s'.lower(), item[:-1].lower() if item[-1] == 's' else '', item+' metal', 'sulfuric '+item]
-                    for alias in aliases:
-                        if not alias:
-                            continue
-                        for craftable, level in craftables:
-                            if alias == craftable.lower():
-                                craft_list.append(f'• {base_name.capitalize()} (at workshop level {level})')
+                for base_name, level in self.workshop_index.lookup(item):
+                    craft_list.append(f'• {base_name.capitalize()} (at workshop level {level})')
                 if len(craft_list) == 0:
                     content = f'Could not find any workshop crafting option for `{item}`'
                     self_delete = True
@@ -1164,7 +2618,7 @@ class Controller:
         content = f'Here is a snapshot of that location ({location_str}).'
         await msg.channel.send(**{
             'content': content,
-            'file': discord.File(image, filename=f'snapshot_{map_controller.get_id()}.png'),
+            'file': discord.File(image, filename=map_controller.get_filename()),
             'reference': msg.to_reference(),
             'mention_author': True,
             })
@@ -1194,16 +2648,70 @@ class Controller:
 
             if Guard.has_permission(msg, 'attach_files'):
                 # If can post image, post the snapshot too
-                image = await map_controller.generate_snapshot(include_world=True)
-                response['file'] = discord.File(image, filename=f'snapshot_{map_controller.get_id()}.png')
+                image = await map_controller.generate_snapshot(include_world=True, persist=True)
+                response['file'] = discord.File(image, filename=map_controller.get_filename())
             await msg.channel.send(**response)
         else:
+            await self.location_not_found(msg, place_name)
+
+    async def route(self, msg, *args):
+        """Replies the user with the distance of each leg and the total distance of a trip through the places mentioned
+        """
+        args = list(args)
+        if args and args[0] == 'best':
+            find_best = True
+            args.pop(0)
+        else:
+            find_best = False
+        if len(args) < 2:
+            await self.help(msg, 'route')
+            return
+        if len(args) > MapController.ROUTE_LIMIT:
             await msg.channel.send(**{
-                'content': f'There is no location named `{place_name}`',
+                'content': f'A route can have at most {MapController.ROUTE_LIMIT} places',
                 'reference': msg.to_reference(),
                 'mention_author': True,
                 'delete_after': 3,
                 })
+            return
+        for place_name in args:
+            if place_name.lower() not in MapController.locations:
+                await self.location_not_found(msg, place_name)
+                return
+        coordinates = [MapController.locations[place_name.lower()][:2] for place_name in args]
+        distances = MapController.location_distances.get_distances(coordinates)
+        order = list(range(len(args)))
+        if find_best:
+            order = find_short_route(distances)
+        legs = []
+        for start, end in zip(order, order[1:]):
+            legs.append(f'• {args[start]} → {args[end]}: {distances[start, end]:.0f}km')
+        total = get_route_length(distances, order)
+        if find_best:
+            content = f'A short route through all {len(args)} places, starting from {args[0]}:\n'
+        else:
+            content = f'The route through the {len(args)} places:\n'
+        content = f'{content}' + '\n'.join(legs) + f'\nTotal: {total:.0f}km'
+        await msg.channel.send(**{
+            'content': content,
+            'reference': msg.to_reference(),
+            'mention_author': True,
+            })
+
+    async def location_not_found(self, msg, place_name):
+        """Replies the user that there is no location with the given name, suggesting similarly named locations
+        """
+        content = f'There is no location named `{place_name}`'
+        matches = MapController.location_fuzzy_index.search(place_name)
+        if matches:
+            suggestions = ', '.join(f'`{name}`' for _, name in matches)
+            content = f'{content}. Did you mean {suggestions}?'
+        await msg.channel.send(**{
+            'content': content,
+            'reference': msg.to_reference(),
+            'mention_author': True,
+            'delete_after': 10 if matches else 3,
+            })
 
     async def distance(self, msg, place1=None, place2=None, *args):
         """Replies the user with the distance between the two place names mentioned
@@ -1216,17 +2724,89 @@ class Controller:
             if place2.lower() not in MapController.locations:
                 raise ValueError(place2)
         except ValueError as e:
+            await self.location_not_found(msg, e.args[0])
+            return
+        lat1, lng1, _ = MapController.locations[place1.lower()]
+        lat2, lng2, _ = MapController.locations[place2.lower()]
+        distance = ((lat1-lat2)**2 + (lng1-lng2)**2)**0.5
+        content = f'The distance between {place1} ({lat1}, {lng1}) and {place2} ({lat2}, {lng2}) is {distance:.0f}km.'
+        await msg.channel.send(**{
+            'content': content,
+            'reference': msg.to_reference(),
+            'mention_author': True,
+            })
+
+    @staticmethod
+    def format_places(places):
+        """Format the list of (distance, point) from the location index as bullet points"""
+        lines = []
+        for distance, (lat, lng, size, label, names) in places:
+            lines.append(f'• {label} ({lat:.2f}, {lng:.2f}): {distance:.0f}km')
+        return '\n'.join(lines)
+
+    async def nearest(self, msg, lat=None, lng=None, k=None, *args):
+        """Replies the user with the named places nearest to the given coordinates
+        """
+        try:
+            lat = float(lat)
+            lng = float(lng)
+            k = int(k) if k else 5
+        except (TypeError, ValueError):
+            await self.help(msg, 'nearest')
+            return
+        if not (math.isfinite(lat) and math.isfinite(lng)) or not MapController(lat, lng).is_valid():
+            # Outside of the map
+            await self.help(msg, 'nearest')
+            return
+        k = max(1, min(k, MapController.NEARBY_LIMIT))
+        places = MapController.location_index.nearest(lat, lng, k)
+        if not places:
             await msg.channel.send(**{
-                'content': f'There is no location named `{e.args[0]}`',
+                'content': 'There are no named places',
                 'reference': msg.to_reference(),
                 'mention_author': True,
                 'delete_after': 3,
                 })
             return
-        lat1, lng1, _ = MapController.locations[place1.lower()]
-        lat2, lng2, _ = MapController.locations[place2.lower()]
-        distance = ((lat1-lat2)**2 + (lng1-lng2)**2)**0.5
-        content = f'The distance between {place1} ({lat1}, {lng1}) and {place2} ({lat2}, {lng2}) is {distance:.0f}km.'
+        content = f'The named places nearest to ({lat:.2f}, {lng:.2f}):\n{Controller.format_places(places)}'
+        await msg.channel.send(**{
+            'content': content,
+            'reference': msg.to_reference(),
+            'mention_author': True,
+            })
+
+    async def around(self, msg, place_name=None, *args):
+        """Replies the user with the named places within the given radius from the given place
+        """
+        if not place_name:
+            return
+        args = list(args)
+        radius = 100
+        if args:
+            try:
+                radius = float(args[-1])
+                args.pop()
+            except ValueError:
+                pass
+            if not math.isfinite(radius):
+                await self.help(msg, 'around')
+                return
+        if args:
+            place_name = f'{place_name} {" ".join(args)}'
+        if place_name.lower() not in MapController.locations:
+            await self.location_not_found(msg, place_name)
+            return
+        lat, lng, _ = MapController.locations[place_name.lower()]
+        places = MapController.location_index.within_radius(lat, lng, radius)
+        # Exclude the place itself
+        places = [(distance, point) for distance, point in places if point[:2] != (lat, lng)]
+        if not places:
+            content = f'There are no named places within {radius:.0f}km of {place_name}'
+        else:
+            content = f'The named places within {radius:.0f}km of {place_name}:\n'
+            content += Controller.format_places(places[:MapController.NEARBY_LIMIT])
+            if len(places) > MapController.NEARBY_LIMIT:
+                content += f'\n...and {len(places)-MapController.NEARBY_LIMIT} more'
         await msg.channel.send(**{
             'content': content,
             'reference': msg.to_reference(),
@@ -1341,7 +2921,11 @@ class Controller:
         fp = BytesIO()
         await msg.attachments[0].save(fp)
         image = Image.open(fp).convert('RGBA')
-        verification_status, username_conf, keyword_conf, font_size = self.verifier.verify(image, username)
+        try:
+            verification_status, username_conf, keyword_conf, font_size = await worker_pool.run(verify_screenshot, image, username)
+        except WorkerPoolFull:
+            await self.busy(msg)
+            return
         logging.info(f'Verification result for {username} ({msg.author.id}): {verification_status}, {username_conf}, {keyword_conf}, {font_size}')
         if verification_status == VerificationStatus.INVALID:
             if tries == 3:
@@ -1413,6 +2997,36 @@ class Controller:
             'mention_author': True,
             })
 
+    async def busy(self, msg):
+        """Replies the user that the bot has too many pending jobs to handle the message
+        """
+        await msg.channel.send(**{
+            'content': 'I am busy right now, please try again in a while',
+            'reference': msg.to_reference(),
+            'mention_author': True,
+            'delete_after': 3,
+            })
+
+    async def wiki_unavailable(self, msg, item):
+        """Replies the user that the page of the item cannot be fetched from the wiki
+        """
+        await msg.channel.send(**{
+            'content': f'Cannot get the page for `{item}` from the wiki right now, please try again later',
+            'reference': msg.to_reference(),
+            'mention_author': True,
+            'delete_after': 3,
+            })
+
+    async def wiki_unparsable(self, msg, item):
+        """Replies the user that the page of the item cannot be parsed
+        """
+        await msg.channel.send(**{
+            'content': f'Cannot read the page for `{item}` from the wiki',
+            'reference': msg.to_reference(),
+            'mention_author': True,
+            'delete_after': 3,
+            })
+
     async def not_found(self, msg, command):
         """Replies the user with the help message, prepended with the information about invalid command
         """
@@ -1498,12 +3112,31 @@ class Controller:
     async def clear_cache(self, msg, *args):
         """Clears the cache
         """
-        Controller.get_wikitext.cache_clear()
-        self.trading_table = None
+        Controller.wiki_cache.clear()
+        Controller.title_index.clear_searches()
+        run(Controller.rebuild_recipe_index())
+        MapController.snapshot_cache.clear()
+        # The current tables are used until the new ones are loaded
+        run(self.refresh_tables())
         await msg.channel.send(**{
             'content': 'Cache cleared',
             })
 
+    @privileged
+    async def set_encoding(self, msg, encoding=None, *args):
+        """Sets the image encoding of the snapshots
+        """
+        if encoding not in Encoding.ALL:
+            content = f'Unknown encoding: `{encoding}`'
+        else:
+            MapController.encoding = encoding
+            content = f'Snapshots will be encoded as {encoding}'
+        await msg.channel.send(**{
+            'content': content,
+            'reference': msg.to_reference(),
+            'mention_author': True,
+            })
+
     def get_status(self):
         content = f'Start time: {self.start_time}\n'
         content = f'{content}KEY_REGEX: {Controller.KEY_REGEX}\n'
@@ -1514,6 +3147,20 @@ class Controller:
         content = f'{content}TRUSTED_ROLES: {Guard.TRUSTED_ROLES}\n'
         content = f'{content}TRUSTED_USERS: {Guard.TRUSTED_USERS}\n'
         content = f'{content}BANNED_USERS: {Guard.BANNED_USERS}\n'
+        content = f'{content}Wiki cache: {Controller.wiki_cache.get_status()}\n'
+        content = f'{content}Wiki fetches: {Controller.wiki_flight.get_status()}\n'
+        content = f'{content}Wiki searches: {Controller.search_flight.get_status()}\n'
+        content = f'{content}Title index: {Controller.title_index.get_status()}\n'
+        content = f'{content}Tables: updated {self.tables_updated}'
+        if self.table_errors:
+            content = f'{content}, failed to refresh {", ".join(self.table_errors)}'
+        content = f'{content}\n'
+        content = f'{content}Recipe index: {Controller.recipe_graph.get_status()}, updated {Controller.recipe_index_updated}\n'
+        content = f'{content}Snapshot cache: {MapController.snapshot_cache.get_status()}\n'
+        content = f'{content}Snapshot disk cache: {MapController.snapshot_disk_cache.get_status()}\n'
+        content = f'{content}Snapshot renders: {MapController.snapshot_flight.get_status()}\n'
+        content = f'{content}Workers: {worker_pool.get_status()}\n'
+        content = f'{content}Snapshot encoding: {MapController.encoding}{MapController.encoding_stats.get_status()}\n'
         content = f'{content}Reply count: {self.reply_count}\n'
         content = f'{content}Reply count per command:'
         for command, count in self.reply_counts.items():
@@ -1659,26 +3306,45 @@ async def on_message(message):
                 })
             return
             
-        matches = re.finditer(MapController.MAP_REGEX, message.content)
-        for idx, match in enumerate(matches):
-            map_controller = MapController.from_match(match)
-            logging.info(f'Generating image for {map_controller}')
-            image = await map_controller.generate_snapshot()
-            snapshot_id = map_controller.get_id().replace('_', ', ')
-            if snapshot_id[0] == 'm':
-                location_str = f'marker at -{snapshot_id[1:]}'
+        matches = list(re.finditer(MapController.MAP_REGEX, message.content))
+        map_controllers = [MapController.from_match(match) for match in matches[:MapController.LINK_LIMIT]]
+        if MapController.LABELS:
+            for map_controller in map_controllers:
+                map_controller.find_labels()
+        logging.info(f'Generating images for {map_controllers}')
+        try:
+            # Render all snapshots concurrently, then reply with all of them in one message
+            images = await gather(*[map_controller.generate_snapshot() for map_controller in map_controllers])
+            if MapController.CONTACT_SHEET and len(images) > 1:
+                image = await worker_pool.run(MapController.render_contact_sheet, [image.getvalue() for image in images],
+                                              MapController.encoding)
+                files = [discord.File(BytesIO(image), filename=f'snapshots.{Encoding.get_extension(MapController.encoding)}')]
             else:
-                location_str = f'center at -{snapshot_id}'
-            if idx == 0:
-                content = f'Here is a snapshot of that location ({location_str}).'
+                files = [discord.File(image, filename=map_controller.get_filename())
+                         for map_controller, image in zip(map_controllers, images)]
+        except WorkerPoolFull:
+            await controller.busy(message)
+            return
+        location_strs = []
+        for map_controller in map_controllers:
+            nearby_str = map_controller.get_nearby_str()
+            if nearby_str:
+                location_strs.append(f'{map_controller.get_location_str()}, {nearby_str}')
             else:
-                content = ''
-            await message.channel.send(**{
-                'content': content,
-                'file': discord.File(image, filename=f'snapshot_{map_controller.get_id()}.png'),
-                'reference': message.to_reference(),
-                'mention_author': True,
-                })
+                location_strs.append(map_controller.get_location_str())
+        location_strs = '; '.join(location_strs)
+        if len(map_controllers) == 1:
+            content = f'Here is a snapshot of that location ({location_strs}).'
+        else:
+            content = f'Here are the snapshots of those locations ({location_strs}).'
+        if len(matches) > len(map_controllers):
+            content = f'{content}\nOnly the first {len(map_controllers)} links are shown.'
+        await message.channel.send(**{
+            'content': content,
+            'files': files,
+            'reference': message.to_reference(),
+            'mention_author': True,
+            })
         run(message.add_reaction('🗺️')) # map emoji
     elif intent == Intent.NONE:
         if message.channel.type == discord.ChannelType.private:
@@ -1695,9 +3361,52 @@ def main(args=None):
                         help='The path to the token')
     parser.add_argument('--location_path', default='location_marker.json',
                         help='The path to list of locations')
+    parser.add_argument('--location_cache_path', default=LOCATION_CACHE_PATH,
+                        help='The directory to store the compiled location database')
+    parser.add_argument('--compile_locations', action='store_true',
+                        help='Only compile the location database (if outdated) and exit')
+    parser.add_argument('--map_storage', choices=['memory', 'mmap'], default=MapController.map_storage,
+                        help='Whether to keep the world map in memory or memory-map it from raw pixel files')
+    parser.add_argument('--map_link_limit', type=int, default=MapController.LINK_LIMIT,
+                        help='The max number of map links in a message to reply with snapshots (at most 10)')
+    parser.add_argument('--map_contact_sheet', action='store_true',
+                        help='Reply to multiple map links with one contact sheet image')
+    parser.add_argument('--map_labels', action='store_true',
+                        help='Label the named places on the snapshots of map links')
+    parser.add_argument('--snapshot_cache_path', default=SNAPSHOT_DISK_CACHE_PATH,
+                        help='The directory to store the snapshots of named locations across restarts')
+    parser.add_argument('--prewarm', action='store_true',
+                        help='Render the snapshots of all named locations in the background after starting')
+    parser.add_argument('--snapshot_encoding', choices=Encoding.ALL, default=MapController.encoding,
+                        help='The image encoding of the snapshots')
+    parser.add_argument('--wiki_cache_path', default=WIKI_CACHE_PATH,
+                        help='The path to the database storing the wiki pages across restarts')
+    parser.add_argument('--wiki_cache_ttl', type=float, default=WIKI_CACHE_TTL,
+                        help='The number of seconds a cached wiki page is served before checking whether it has changed')
+    parser.add_argument('--title_index_interval', type=float, default=TITLE_INDEX_INTERVAL,
+                        help='The number of seconds between the updates of the index of wiki page titles')
+    parser.add_argument('--recipe_index_interval', type=float, default=RECIPE_INDEX_INTERVAL,
+                        help='The number of seconds between the updates of the index of the ingredients used in each recipe')
+    parser.add_argument('--table_refresh_interval', type=float, default=TABLE_REFRESH_INTERVAL,
+                        help='The number of seconds between the refreshes of the trading, buyer, and workshop tables')
+    parser.add_argument('--http_connection_limit', type=int, default=HTTP_CONNECTION_LIMIT,
+                        help='The max number of simultaneous connections to the wiki')
+    parser.add_argument('--http_timeout', type=float, default=HTTP_TIMEOUT,
+                        help='The max number of seconds for each request to the wiki')
+    parser.add_argument('--workers', type=int, default=WORKER_COUNT,
+                        help='The number of workers for snapshot rendering and screenshot verification')
+    parser.add_argument('--worker_type', choices=['thread', 'process'], default=WORKER_TYPE,
+                        help='Whether the workers are threads or processes')
+    parser.add_argument('--worker_start_method', choices=['spawn', 'forkserver', 'fork'], default=WORKER_START_METHOD,
+                        help='How the worker processes are started')
+    parser.add_argument('--worker_queue_limit', type=int, default=WORKER_QUEUE_LIMIT,
+                        help='The max number of jobs waiting for the workers before new ones are rejected')
     args = parser.parse_args(args)
     token_path = args.token_path
     location_path = args.location_path
+    if args.compile_locations:
+        MapController.compile_locations(location_path, args.location_cache_path)
+        return
     try:
         with open(token_path, 'r') as infile:
             TOKEN = infile.read().strip()
@@ -1719,20 +3428,37 @@ def main(args=None):
     Guard.SUDO_IDS.add(Guard.AUTHOR)
     try:
         # Map all location names (in all languages) into their lat, lng and size (for name collision handling)
-        with open(location_path, 'r') as infile:
-            location_data = json.load(infile)
-        for location in location_data:
-            lng, lat = location['geometry']['coordinates']
-            size = location['properties']['size']
-            for name in location['properties']['name'].values():
-                name = name.lower()
-                if '<br>' in name:
-                    name = name.split('<br>/ ')[-1]
-                if name not in MapController.locations or size > MapController.locations[name][2]:
-                    MapController.locations[name] = (lat, lng, size)
+        MapController.load_locations(location_path, args.location_cache_path)
     except:
         logging.info(f'Cannot read location marker data from {location_path}')
-    client.run(TOKEN)
+    MapController.map_storage = args.map_storage
+    MapController.LINK_LIMIT = min(args.map_link_limit, 10) # Discord allows up to 10 attachments
+    MapController.CONTACT_SHEET = args.map_contact_sheet
+    MapController.LABELS = args.map_labels
+    MapController.PREWARM = args.prewarm
+    MapController.encoding = args.snapshot_encoding
+    Controller.HTTP_CONNECTION_LIMIT = args.http_connection_limit
+    Controller.HTTP_TIMEOUT = args.http_timeout
+    Controller.WIKI_CACHE_TTL = args.wiki_cache_ttl
+    Controller.TITLE_INDEX_INTERVAL = args.title_index_interval
+    Controller.RECIPE_INDEX_INTERVAL = args.recipe_index_interval
+    Controller.TABLE_REFRESH_INTERVAL = args.table_refresh_interval
+    try:
+        Controller.wiki_cache.open(args.wiki_cache_path)
+    except sqlite3.Error as e:
+        logging.error(f'Cannot open the wiki cache: {e}')
+    try:
+        MapController.snapshot_disk_cache.path = Path(args.snapshot_cache_path)
+        MapController.snapshot_disk_cache.open(MapController.get_assets_digest())
+    except OSError as e:
+        logging.error(f'Cannot open the snapshot disk cache: {e}')
+    if args.map_storage == 'mmap':
+        MapController.update_map_cache()
+    worker_pool.start(args.workers, args.worker_type, args.worker_queue_limit, args.worker_start_method)
+    try:
+        client.run(TOKEN)
+    finally:
+        worker_pool.shutdown()
 
 if __name__ == '__main__':
     main()
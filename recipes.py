@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+To expand the crafting recipes in Day R down to the raw materials
+"""
+from __future__ import print_function, division
+__date__ = '2026-10-16'
+
+# Import statements
+from collections import OrderedDict
+
+def parse_amount(amount):
+    """Returns the amount in a recipe as an integer, where missing or unreadable amounts count as 1"""
+    try:
+        return int(str(amount).replace(',', '').strip())
+    except ValueError:
+        return 1
+
+class RecipeGraph:
+    """Memoised graph from item title into the ingredients of its crafting recipe
+
+    Each ingredient is (title, emoji key, name, amount). Items without a crafting recipe are stored with None,
+    so that each page is only looked at once.
+    The reverse edges are kept as well, to find the items crafted with an ingredient.
+    """
+    def __init__(self):
+        self.edges = {}
+        self.uses = {}
+
+    def __contains__(self, title):
+        return title in self.edges
+
+    def __len__(self):
+        return len(self.edges)
+
+    def get(self, title):
+        return self.edges.get(title)
+
+    def add(self, title, ingredients):
+        """Sets the ingredients of the item, replacing the previous ones"""
+        self.discard(title)
+        self.edges[title] = ingredients
+        for child, _, _, amount in ingredients or []:
+            self.uses.setdefault(child.lower(), {})[title] = amount
+
+    def discard(self, title):
+        for child, _, _, _ in self.edges.pop(title, None) or []:
+            products = self.uses.get(child.lower(), {})
+            products.pop(title, None)
+            if not products:
+                self.uses.pop(child.lower(), None)
+
+    def clear(self):
+        self.edges = {}
+        self.uses = {}
+
+    def get_uses(self, title):
+        """Returns the mapping from the title of each item crafted with the item (ignoring case) into the amount needed"""
+        return self.uses.get(title.lower(), {})
+
+    def get_status(self):
+        recipes = sum(1 for ingredients in self.edges.values() if ingredients)
+        return f'{len(self.edges)} items, {recipes} recipes, {len(self.uses)} ingredients'
+
+    def get_children(self, titles):
+        """Returns the titles of the ingredients of the given titles that are already in the graph"""
+        children = []
+        for title in titles:
+            for child, _, _, _ in self.edges.get(title) or []:
+                children.append(child)
+        return children
+
+    def expand(self, title, quantity=1, max_depth=10):
+        """Expands the recipe of quantity of the item down to the raw materials
+
+        Returns (tree, totals), where tree is the list of (depth, emoji key, name, quantity) of all ingredients
+        in depth-first order, and totals maps the title of each raw material into [emoji key, name, total quantity].
+        An ingredient is a raw material if it has no crafting recipe in the graph, if it is needed to craft itself
+        (a cycle), or if it is deeper than max_depth.
+        """
+        tree = []
+        totals = OrderedDict()
+        def visit(title, quantity, depth, path):
+            for child, key, name, amount in self.edges.get(title) or []:
+                child_quantity = quantity * parse_amount(amount)
+                tree.append((depth, key, name, child_quantity))
+                if self.edges.get(child) and child not in path and depth < max_depth:
+                    visit(child, child_quantity, depth+1, path | {child})
+                elif child in totals:
+                    totals[child][2] += child_quantity
+                else:
+                    totals[child] = [key, name, child_quantity]
+        visit(title, quantity, 0, {title})
+        return tree, totals
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of extracting the crafting recipes from the wiki pages
+"""
+from __future__ import print_function, division
+__date__ = '2026-10-16'
+
+# Import statements
+import asyncio
+import discord
+import pytest
+import main
+from main import Controller, PageParseError
+from recipes import RecipeGraph
+from wikicache import WikiCache
+
+PAGES = {
+    'Hammer': '{{Recipe|input={{Ingredients|Wood|2|Iron|1}}}}',
+    'Wood': 'A raw material',
+    'Iron': 'A raw material',
+    # The amount of the last ingredient is missing
+    'Axe': '{{Recipe|input={{Ingredients|Wood|3|Iron}}}}',
+    # A bullet without an amount
+    'Spear': '{{Recipe|input=\n*[[Wood]] x2\n*[[Iron]]}}',
+    }
+
+@pytest.fixture
+def wiki(monkeypatch):
+    """Serves PAGES as the wiki, with the recipe graph and the caches emptied"""
+    pages = dict(PAGES)
+    async def get_wikitexts(titles):
+        return {title: pages[title] for title in titles if title in pages}
+    async def query_all(url, params=None):
+        yield {'embeddedin': [{'title': title} for title in pages if 'Recipe' in pages[title]]}
+    async def get_changed_titles(titles):
+        return []
+    monkeypatch.setattr(Controller, 'get_wikitexts', staticmethod(get_wikitexts))
+    monkeypatch.setattr(Controller, 'query_all', staticmethod(query_all))
+    monkeypatch.setattr(Controller, 'get_changed_titles', staticmethod(get_changed_titles))
+    monkeypatch.setattr(Controller, 'RECIPE_TEMPLATES', ['Template:Recipe'])
+    monkeypatch.setattr(Controller, 'recipe_graph', RecipeGraph())
+    monkeypatch.setattr(Controller, 'wiki_cache', WikiCache())
+    monkeypatch.setattr(Controller, 'recipe_index_updated', None)
+    return pages
+
+def test_parse_recipe_with_missing_amounts():
+    ingredients = Controller.parse_recipe(PAGES['Axe'])['recipe']['ingredients']
+    assert ingredients == [['wood', 'Wood', '3'], ['iron', 'Iron', None]]
+    ingredients = Controller.parse_recipe(PAGES['Spear'])['recipe']['ingredients']
+    assert ingredients == [['wood', 'Wood', '2']]
+
+def test_update_recipe_index_with_malformed_page(wiki, monkeypatch):
+    parse_recipe = Controller.parse_recipe
+    def parse(wikitext):
+        if wikitext == wiki['Axe']:
+            raise ValueError('Malformed recipe')
+        return parse_recipe(wikitext)
+    monkeypatch.setattr(Controller, 'parse_recipe', staticmethod(parse))
+    asyncio.run(Controller.update_recipe_index())
+    assert Controller.recipe_index_updated is not None
+    assert Controller.recipe_graph.get('Axe') is None
+    assert 'Axe' in Controller.recipe_graph
+    assert Controller.recipe_graph.get_uses('Wood') == {'Hammer': '2', 'Spear': '2'}
+
+class Message:
+    """Message sent to the bot, keeping the replies"""
+    def __init__(self):
+        self.guild = None
+        self.channel = self
+        self.type = discord.ChannelType.private
+        self.replies = []
+
+    def to_reference(self):
+        return None
+
+    async def send(self, content=None, **kwargs):
+        self.replies.append(content)
+
+def test_recipe_tree_with_malformed_ingredient(wiki, monkeypatch):
+    parse_recipe = Controller.parse_recipe
+    def parse(wikitext):
+        if wikitext == wiki['Iron']:
+            raise IndexError('Malformed recipe')
+        return parse_recipe(wikitext)
+    async def canonical_title(title):
+        return None
+    monkeypatch.setattr(Controller, 'parse_recipe', staticmethod(parse))
+    monkeypatch.setattr(Controller, 'canonical_title', staticmethod(canonical_title))
+    msg = Message()
+    asyncio.run(Controller().recipe_tree(msg, 'Hammer', '2'))
+    assert Controller.recipe_graph.get('Iron') is None
+    assert msg.replies[0].startswith('To craft Hammer x2, you need:')
+    assert 'Which is in total:\n• Wood x4\n• Iron x2' in msg.replies[0]
+
+def test_recipe_and_info_with_malformed_page(wiki, monkeypatch):
+    def parse(wikitext):
+        raise ValueError('Malformed page')
+    async def canonical_title(title):
+        return None
+    monkeypatch.setattr(Controller, 'parse_recipe', staticmethod(parse))
+    monkeypatch.setattr(Controller, 'parse_infoboxes', staticmethod(parse))
+    monkeypatch.setattr(Controller, 'canonical_title', staticmethod(canonical_title))
+    with pytest.raises(PageParseError):
+        asyncio.run(Controller.get_parsed('Hammer', 'recipe', Controller.parse_recipe))
+    msg = Message()
+    asyncio.run(Controller().recipe(msg, 'Hammer'))
+    asyncio.run(Controller().info(msg, 'Hammer'))
+    asyncio.run(Controller().info(msg, 'Sword'))
+    assert msg.replies == ['Cannot read the page for `Hammer` from the wiki',
+                           'Cannot read the page for `Hammer` from the wiki',
+                           'No page found for `Sword`']
+
+def test_rebuild_recipe_index_waits_for_update_in_flight(wiki, monkeypatch):
+    update_recipe_index = Controller.update_recipe_index
+    running = []
+    async def update():
+        assert not running
+        running.append(True)
+        # Let the rebuild start while this update is in flight
+        await asyncio.sleep(0.01)
+        await update_recipe_index()
+        running.pop()
+    monkeypatch.setattr(Controller, 'update_recipe_index', staticmethod(update))
+    monkeypatch.setattr(Controller, 'recipe_index_flight', main.SingleFlight())
+    async def run():
+        first = asyncio.ensure_future(Controller.recipe_index_flight.run('recipe_index', Controller.update_recipe_index))
+        await asyncio.sleep(0)
+        await Controller.rebuild_recipe_index()
+        await first
+    asyncio.run(run())
+    assert Controller.recipe_index_updated is not None
+    assert Controller.recipe_graph.get_uses('Wood') == {'Hammer': '2', 'Axe': '3', 'Spear': '2'}
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+To cache the wiki pages on disk across restarts, and to resolve page titles locally
+"""
+from __future__ import print_function, division
+__date__ = '2026-10-16'
+
+# Import statements
+import json
+import sqlite3
+import time
+
+class WikiCache:
+    """Cache of wikitext in an SQLite database, keyed by title
+
+    Each page is stored with its revision id and the time it was last fetched or confirmed to be the latest,
+    so that the caller can decide when to revalidate it.
+    The data extracted from each page can be stored too, and is discarded when the page changes.
+    The titles resolved from the names asked for are stored as well, to resolve them before the title index is loaded.
+    Before the cache is opened, nothing is cached.
+    """
+    def __init__(self, path=None):
+        self.connection = None
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.updates = 0
+        self.parsed_hits = 0
+        self.parsed_misses = 0
+        if path is not None:
+            self.open(path)
+
+    def open(self, path):
+        """Opens (and creates if needed) the database at the path"""
+        self.close()
+        self.connection = sqlite3.connect(str(path), isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS pages ('
+                                'title TEXT PRIMARY KEY, revid INTEGER, wikitext TEXT NOT NULL, fetched REAL NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS parsed ('
+                                'title TEXT NOT NULL, kind TEXT NOT NULL, revid INTEGER, data TEXT NOT NULL, '
+                                'PRIMARY KEY (title, kind))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS titles (name TEXT PRIMARY KEY, title TEXT NOT NULL)')
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def get(self, title):
+        """Returns (revid, wikitext, fetched) of the title, or None if not cached or the cache is not open"""
+        if self.connection is None:
+            return None
+        row = self.connection.execute('SELECT revid, wikitext, fetched FROM pages WHERE title = ?', (title,)).fetchone()
+        if row is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return row
+
+    def put(self, title, revid, wikitext):
+        """Stores the wikitext of the title as fetched now, if the cache is open"""
+        if self.connection is None:
+            return
+        with self.connection:
+            self.connection.execute('BEGIN')
+            self.connection.execute('INSERT OR REPLACE INTO pages (title, revid, wikitext, fetched) VALUES (?, ?, ?, ?)',
+                                    (title, revid, wikitext, time.time()))
+            self.connection.execute('DELETE FROM parsed WHERE title = ? AND revid IS NOT ?', (title, revid))
+
+    def touch(self, title):
+        """Marks the cached wikitext of the title as confirmed to be the latest now"""
+        if self.connection is None:
+            return
+        self.connection.execute('UPDATE pages SET fetched = ? WHERE title = ?', (time.time(), title))
+
+    def get_parsed(self, title, kind):
+        """Returns (data, revid, fetched) of the data of the kind extracted from the cached page of the title,
+        or None if not cached
+        """
+        if self.connection is None:
+            return None
+        row = self.connection.execute('SELECT parsed.data, pages.revid, pages.fetched FROM parsed '
+                                      'JOIN pages ON parsed.title = pages.title AND parsed.revid IS pages.revid '
+                                      'WHERE parsed.title = ? AND parsed.kind = ?', (title, kind)).fetchone()
+        if row is None:
+            self.parsed_misses += 1
+            return None
+        self.parsed_hits += 1
+        data, revid, fetched = row
+        return json.loads(data), revid, fetched
+
+    def put_parsed(self, title, kind, data):
+        """Stores the data of the kind extracted from the cached page of the title, if the page is cached"""
+        if self.connection is None:
+            return
+        self.connection.execute('INSERT OR REPLACE INTO parsed (title, kind, revid, data) '
+                                'SELECT title, ?, revid, ? FROM pages WHERE title = ?', (kind, json.dumps(data), title))
+
+    def get_title(self, name):
+        """Returns the title stored for the name, or the title of a cached page matching one of its forms,
+        or None if not found
+        """
+        if self.connection is None:
+            return None
+        name = normalize_title(name)
+        row = self.connection.execute('SELECT title FROM titles WHERE name = ?', (name,)).fetchone()
+        if row is not None:
+            return row[0]
+        for form in [name] + get_singular_plural_forms(name):
+            row = self.connection.execute('SELECT title FROM pages WHERE title = ? COLLATE NOCASE', (form,)).fetchone()
+            if row is not None:
+                return row[0]
+        return None
+
+    def put_title(self, name, title):
+        """Stores the title resolved from the name"""
+        if self.connection is None:
+            return
+        self.connection.execute('INSERT OR REPLACE INTO titles (name, title) VALUES (?, ?)', (normalize_title(name), title))
+
+    def clear(self):
+        if self.connection is None:
+            return
+        with self.connection:
+            self.connection.execute('BEGIN')
+            self.connection.execute('DELETE FROM pages')
+            self.connection.execute('DELETE FROM parsed')
+            self.connection.execute('DELETE FROM titles')
+
+    def __len__(self):
+        if self.connection is None:
+            return 0
+        return self.connection.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+
+    def get_status(self):
+        if self.connection is None:
+            return 'disabled'
+        return (f'{len(self)} pages, {self.hits} hits, {self.misses} misses, '
+                f'{self.revalidations} revalidations, {self.updates} updates, '
+                f'{self.parsed_hits} parsed hits, {self.parsed_misses} parsed misses')
+
+def normalize_title(title):
+    """Returns the lowercase form of the title used to look it up"""
+    return ' '.join(title.replace('_', ' ').split()).lower()
+
+def get_singular_plural_forms(title):
+    """Returns the possible singular or plural forms of the normalized title"""
+    forms = []
+    if title.endswith('ies'):
+        forms.append(f'{title[:-3]}y')
+    if title.endswith('es'):
+        forms.append(title[:-2])
+    if title.endswith('s'):
+        forms.append(title[:-1])
+    else:
+        forms.append(f'{title}s')
+        forms.append(f'{title}es')
+    return forms
+
+class TitleIndex:
+    """In-memory index of the titles of the wiki pages and redirects, to resolve titles without searching the wiki
+
+    The results of the searches done on a miss are stored as well, including the searches with no result,
+    until the index is updated.
+    """
+    def __init__(self):
+        self.exact_titles = set()
+        self.titles = {}
+        self.redirects = {}
+        self.searches = {}
+        self.updated = None
+        self.hits = 0
+        self.misses = 0
+
+    def update(self, titles, redirects):
+        """Replaces the index with the list of page titles and the list of (redirect title, target title)"""
+        self.exact_titles = set(titles)
+        self.titles = {normalize_title(title): title for title in titles}
+        self.redirects = {normalize_title(source): target for source, target in redirects}
+        self.searches = {}
+        self.updated = time.time()
+
+    def lookup(self, title):
+        """Returns the page title for the normalized title, following a redirect, or None if not found"""
+        if title in self.titles:
+            return self.titles[title]
+        return self.redirects.get(title)
+
+    def resolve(self, title):
+        """Returns the page title matching the title exactly, ignoring case, through a redirect,
+        or as its singular or plural form. Returns None if not found
+        """
+        if title in self.exact_titles:
+            self.hits += 1
+            return title
+        title = normalize_title(title)
+        for form in [title] + get_singular_plural_forms(title):
+            result = self.lookup(form)
+            if result is not None:
+                self.hits += 1
+                return result
+        self.misses += 1
+        return None
+
+    def get_search(self, title, negative_ttl):
+        """Returns (True, result) if the result of searching the title is stored, and (False, None) otherwise
+
+        Searches with no result are only stored for negative_ttl seconds.
+        """
+        title = normalize_title(title)
+        if title not in self.searches:
+            return False, None
+        result, searched = self.searches[title]
+        if result is None and time.time()-searched > negative_ttl:
+            del self.searches[title]
+            return False, None
+        return True, result
+
+    def put_search(self, title, result):
+        self.searches[normalize_title(title)] = (result, time.time())
+
+    def clear_searches(self):
+        self.searches = {}
+
+    def __len__(self):
+        return len(self.titles)
+
+    def get_status(self):
+        if self.updated is None:
+            content = 'not loaded'
+        else:
+            content = f'{len(self.titles)} titles, {len(self.redirects)} redirects, updated {time.ctime(self.updated)}'
+        return f'{content}, {self.hits} hits, {self.misses} misses, {len(self.searches)} searches stored'